@@ -0,0 +1,40 @@
+"""
+Benchmark the per-instance cost of loading content models, compared with
+hashing content_raw in __init__ as every loaded Topic/Post/Appendix used to do
+
+    python benchmarks/content_models.py
+"""
+import os
+import sys
+import timeit
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'test_settings'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import django
+django.setup()
+
+import xxhash
+from niji.models import Post
+
+
+def main(number=20000):
+    field_names = [f.attname for f in Post._meta.concrete_fields]
+    for size in (200, 2000, 20000):
+        content_raw = "x" * size
+        values = [content_raw if name == 'content_raw' else None for name in field_names]
+
+        def lazy():
+            Post.from_db('default', field_names, values)
+
+        def eager():
+            Post.from_db('default', field_names, values)
+            xxhash.xxh64(content_raw).hexdigest()
+
+        for name, func in (("eager hash", eager), ("lazy hash", lazy)):
+            seconds = timeit.timeit(func, number=number)
+            print("{:>6} bytes {:>10}: {:6.2f} us/instance".format(size, name, seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Benchmark the render pipeline on worst-case mention and markdown input
+
+    python benchmarks/guards.py
+"""
+import os
+import sys
+import time
+import re
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'test_settings'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import django
+django.setup()
+
+from niji.models import find_mentions, link_mentions, render_markdown
+
+UNBOUNDED_LINK_REGEX = re.compile(r'@(?P<username>\S+?)(?P<whitespace>\s|</p>)', re.M)
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return (time.time() - start) * 1000
+
+
+def main():
+    links = {'a': '/u/1/'}
+    for size in (1000, 10000, 20000):
+        content = '@' * size
+        print("{:>6} @ signs    find_mentions: {:8.1f} ms".format(size, timed(find_mentions, content, 'sender')))
+        print("{:>6} @ signs    link_mentions: {:8.1f} ms".format(size, timed(link_mentions, content, links)))
+        print("{:>6} @ signs  unbounded regex: {:8.1f} ms".format(
+            size, timed(UNBOUNDED_LINK_REGEX.sub, lambda m: m.group(0), content)
+        ))
+    for name, content in (('20000 x "<"', '<' * 20000), ('5000 x "`"', '`' * 5000)):
+        print("{:>16}  render_markdown: {:8.1f} ms".format(name, timed(render_markdown, content)))
+
+
+if __name__ == "__main__":
+    main()
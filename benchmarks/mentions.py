@@ -0,0 +1,55 @@
+"""
+Benchmark mention linking over rendered posts with 0, 10 and 100 mentions
+
+    python benchmarks/mentions.py
+"""
+import os
+import sys
+import timeit
+from functools import partial
+import re
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'test_settings'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import django
+django.setup()
+
+import mistune
+from niji.models import link_mentions
+
+
+def legacy_link_mentions(content_rendered, links):
+    # One compiled pattern and one full pass per mentioned user
+    for username, link in links.items():
+        content_rendered = re.sub(
+            r'(?P<username>@%s)(?P<whitespace>\s|<\/p>)' % username,
+            partial(
+                lambda l, m: "@<a href=\"%s\">%s</a>%s" % (l, m.group("username")[1:], m.group("whitespace")),
+                link
+            ),
+            content_rendered,
+            re.M
+        )
+    return content_rendered
+
+
+def make_post(mentions):
+    words = ["lorem ipsum dolor sit amet consectetur"] * 50
+    words += ["@user%d" % i for i in range(mentions)]
+    words += ["adipiscing elit sed do eiusmod"] * 50
+    links = dict(("user%d" % i, "/u/%d/" % i) for i in range(mentions))
+    return mistune.markdown(" ".join(words)), links
+
+
+def main(number=200):
+    for mentions in (0, 10, 100):
+        content_rendered, links = make_post(mentions)
+        assert link_mentions(content_rendered, links) == legacy_link_mentions(content_rendered, links)
+        for name, func in (("legacy", legacy_link_mentions), ("single-pass", link_mentions)):
+            seconds = timeit.timeit(lambda: func(content_rendered, links), number=number)
+            print("{:>4} mentions {:>12}: {:8.1f} us/post".format(mentions, name, seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -68,14 +68,21 @@ class TopicAdmin(admin.ModelAdmin):
 class NodeAdmin(admin.ModelAdmin):
 
     def number_of_topics(self, obj):
-        topics = Topic.objects.filter(node=obj)
-        return "{}({})".format(topics.count(), topics.visible().count())
+        return "{}({})".format(obj.topic_count, obj.visible_topic_count)
 
     number_of_topics.short_description = "Number of Topics [total(visible)]"
 
     list_display = (
         'title',
-        'number_of_topics'
+        'number_of_topics',
+        'post_count',
+        'last_activity',
+    )
+    readonly_fields = (
+        'topic_count',
+        'visible_topic_count',
+        'post_count',
+        'last_activity',
     )
     search_fields = (
         'title',
@@ -1,7 +1,9 @@
 from rest_framework import viewsets
 from rest_framework.authentication import SessionAuthentication
+from rest_framework.response import Response
 from niji.models import Topic, Post
 from niji.serializers import TopicSerializer, PostSerializer
+from niji.conditional import conditional_response
 
 
 class SessionAuthenticationExemptCSRF(SessionAuthentication):
@@ -10,13 +12,37 @@ class SessionAuthenticationExemptCSRF(SessionAuthentication):
         return
 
 
-class TopicApiView(viewsets.ModelViewSet):
+class ConditionalRetrieveMixin(object):
+    """
+    Answers conditional GET requests for single objects with 304 when unchanged
+    """
+
+    def get_last_modified(self, instance):
+        """
+        :return: datetime the object last changed at, None to skip validation
+        """
+        return getattr(instance, 'last_modified', None)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return conditional_response(
+            request, self.get_last_modified(instance),
+            lambda: Response(self.get_serializer(instance).data),
+            request.accepted_renderer.format
+        )
+
+
+class TopicApiView(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     authentication_classes = (SessionAuthenticationExemptCSRF,)
     queryset = Topic.objects.all()
     serializer_class = TopicSerializer
 
 
-class PostApiView(viewsets.ModelViewSet):
+class PostApiView(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     authentication_classes = (SessionAuthenticationExemptCSRF,)
-    queryset = Post.objects.all()
+    queryset = Post.objects.select_related('topic')
     serializer_class = PostSerializer
+
+    def get_last_modified(self, instance):
+        # Replies mark their topic as modified
+        return instance.topic.last_modified
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.utils.translation import ugettext as _
+from six.moves.urllib.parse import urlencode
+from io import BytesIO
+import hashlib
+import json
+import xxhash
+
+# thumbnails is a tuple of (size, url) by size, empty until they are made
+AvatarInfo = namedtuple('AvatarInfo', ['gravatar_hash', 'use_gravatar', 'thumbnails'])
+
+GRAVATAR_URL = 'http://www.gravatar.com/avatar/'
+_EXTENSIONS = {'WEBP': 'webp', 'PNG': 'png', 'JPEG': 'jpg'}
+# Formats uploaded avatars are accepted in, with the extension the original is stored under
+UPLOAD_FORMATS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'WEBP': 'webp'}
+
+
+def _get_cache():
+    return caches[getattr(settings, 'NIJI_AVATAR_CACHE_ALIAS', 'default')]
+
+
+def _get_timeout():
+    return getattr(settings, 'NIJI_AVATAR_CACHE_TIMEOUT', 3600)
+
+
+def _avatar_key(user_id):
+    # Versioned with AvatarInfo, entries of an older one can't be unpickled
+    return 'niji:avatar:2:%s' % user_id
+
+
+def gravatar_hash(email):
+    return hashlib.md5((email or '').strip().lower().encode('utf-8')).hexdigest()
+
+
+def gravatar_url(email_hash, size):
+    return GRAVATAR_URL + email_hash + '?' + urlencode({'d': '', 's': str(size)})
+
+
+def get_avatar_sizes():
+    return getattr(settings, 'NIJI_AVATAR_SIZES', (28, 48, 120))
+
+
+def get_avatar_format():
+    """
+    :return: PIL format thumbnails are saved in, PNG if NIJI_AVATAR_FORMAT isn't supported
+    """
+    from PIL import Image
+    Image.init()
+    avatar_format = getattr(settings, 'NIJI_AVATAR_FORMAT', 'WEBP').upper()
+    if avatar_format not in _EXTENSIONS or avatar_format not in Image.SAVE:
+        return 'PNG'
+    return avatar_format
+
+
+def get_upload_name(upload):
+    """
+    Check an uploaded avatar with PIL and name it after its content, never after the uploaded
+    name, whose extension may claim any type
+    :param upload: file of the upload
+    :return: name of the form <content digest>.<extension of the verified format>
+    :raise ValidationError: if it isn't an image in one of UPLOAD_FORMATS
+    """
+    from PIL import Image
+    upload.seek(0)
+    data = upload.read()
+    upload.seek(0)
+    try:
+        image = Image.open(BytesIO(data))
+        image.verify()
+    except Exception:
+        # PIL raises all sorts of exceptions on malformed images
+        raise ValidationError(_('Upload a valid image.'), code='invalid_image')
+    if image.format not in UPLOAD_FORMATS:
+        raise ValidationError(_('Upload a PNG, JPEG, GIF or WebP image.'), code='invalid_image_format')
+    return '%s.%s' % (xxhash.xxh64(data).hexdigest(), UPLOAD_FORMATS[image.format])
+
+
+def delete_thumbnails(storage, names):
+    """
+    Delete thumbnails no avatar uses anymore, the same content uploaded by another user shares them
+    :param names: names of replaced thumbnails
+    """
+    from niji.models import ForumAvatar
+    for name in set(names):
+        if not ForumAvatar.objects.filter(thumbnails__contains=json.dumps(name)).exists():
+            storage.delete(name)
+
+
+def make_thumbnails(image, prefix, replaced=()):
+    """
+    Save thumbnails of an image in each of NIJI_AVATAR_SIZES, named after the image content
+    :param image: stored FieldFile of the original image
+    :param prefix: path the thumbnails are saved under
+    :param replaced: names of the thumbnails of the image this one replaces, deleted unless still used
+    :return: dict of size -> thumbnail name
+    """
+    from PIL import Image
+    image.open('rb')
+    try:
+        data = image.read()
+    finally:
+        image.close()
+    digest = xxhash.xxh64(data).hexdigest()
+    avatar_format = get_avatar_format()
+    original = Image.open(BytesIO(data))
+    original.load()
+    has_alpha = original.mode in ('RGBA', 'LA') or 'transparency' in original.info
+    original = original.convert('RGBA' if has_alpha and avatar_format != 'JPEG' else 'RGB')
+    thumbnails = {}
+    for size in get_avatar_sizes():
+        name = '%s%s-%s.%s' % (prefix, digest, size, _EXTENSIONS[avatar_format])
+        # Same content, same name: already saved for an earlier upload
+        if not image.storage.exists(name):
+            thumbnail = original.copy()
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+            buf = BytesIO()
+            thumbnail.save(buf, format=avatar_format)
+            name = image.storage.save(name, ContentFile(buf.getvalue()))
+        thumbnails[size] = name
+    delete_thumbnails(image.storage, set(replaced) - set(thumbnails.values()))
+    return thumbnails
+
+
+def get_avatar_info(user, avatar):
+    """
+    :param avatar: the user's ForumAvatar, None if there is none
+    """
+    if avatar is None:
+        return AvatarInfo(gravatar_hash(user.email), True, ())
+    thumbnails = ()
+    if avatar.image and avatar.thumbnails:
+        storage = avatar.image.storage
+        thumbnails = tuple(sorted(
+            (int(size), storage.url(name)) for size, name in json.loads(avatar.thumbnails).items()
+        ))
+    return AvatarInfo(avatar.gravatar_hash or gravatar_hash(user.email), avatar.use_gravatar, thumbnails)
+
+
+def pick_thumbnail(thumbnails, size):
+    """
+    :param thumbnails: tuple of (size, url) by size
+    :return: url of the smallest thumbnail at least size large, else of the largest
+    """
+    for thumbnail_size, url in thumbnails:
+        if thumbnail_size >= size:
+            return url
+    return thumbnails[-1][1]
+
+
+def invalidate_avatar(user_id):
+    _get_cache().delete(_avatar_key(user_id))
+
+
+class AvatarResolver(object):
+    """
+    Resolves avatar URLs once per user and size. Avatars already loaded along with
+    the users are used as is, others are cached for NIJI_AVATAR_CACHE_TIMEOUT seconds.
+    """
+
+    def __init__(self):
+        self._infos = {}
+        self._urls = {}
+
+    def get_info(self, user):
+        info = self._infos.get(user.pk)
+        if info is not None:
+            return info
+        from niji.models import ForumAvatar
+        if hasattr(user, get_user_model().forum_avatar.cache_name):
+            # select_related or prefetch_related, None if there is no avatar
+            try:
+                avatar = user.forum_avatar
+            except ForumAvatar.DoesNotExist:
+                avatar = None
+            info = get_avatar_info(user, avatar)
+        else:
+            cache = _get_cache()
+            info = cache.get(_avatar_key(user.pk))
+            if info is None:
+                info = get_avatar_info(user, ForumAvatar.objects.filter(user_id=user.pk).first())
+                cache.set(_avatar_key(user.pk), info, _get_timeout())
+        self._infos[user.pk] = info
+        return info
+
+    def url(self, user, size=48, no_gravatar=False):
+        key = (user.pk, size, no_gravatar)
+        url = self._urls.get(key)
+        if url is None:
+            info = self.get_info(user)
+            if info.thumbnails and not (info.use_gravatar and not no_gravatar):
+                url = pick_thumbnail(info.thumbnails, int(size))
+            else:
+                # Also until an uploaded image is processed, the original is never shown
+                url = gravatar_url(info.gravatar_hash, size)
+            self._urls[key] = url
+        return url
+
+
+def get_avatar_resolver(request):
+    """
+    :return: the AvatarResolver of a request, a new one if there is no request
+    """
+    if request is None:
+        return AvatarResolver()
+    resolver = getattr(request, '_niji_avatar_resolver', None)
+    if resolver is None:
+        resolver = request._niji_avatar_resolver = AvatarResolver()
+    return resolver
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from calendar import timegm
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import get_language
+from niji.models import RENDERER_VERSION
+from niji.page_cache import get_site_modified
+from niji.unread import get_unread_count
+import six
+import xxhash
+
+
+def conditional_response(request, last_modified, get_response, *parts):
+    """
+    Answer a conditional GET with 304 if the resource didn't change, or build the response
+    :param last_modified: datetime the resource last changed at, None to always build the response
+    :param get_response: callable building the response
+    :param parts: anything else the response depends on
+    :return: response with ETag and Last-Modified set, both also moved by changes shown
+             on every page (usernames, avatars, nodes) and by a new renderer version
+    """
+    if last_modified is None:
+        return get_response()
+    last_modified = max(last_modified, get_site_modified())
+    parts = [request.get_full_path(), last_modified.isoformat(), get_language(), RENDERER_VERSION] + list(parts)
+    timestamp = None
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        # Pages also show the unread notifications, which have no time to go by
+        parts.extend([user.pk, get_unread_count(user.pk)])
+    else:
+        timestamp = timegm(last_modified.utctimetuple())
+    etag = xxhash.xxh64('|'.join(six.text_type(part) for part in parts).encode('utf-8')).hexdigest()
+
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = get_response()
+    if not response.has_header('ETag'):
+        response['ETag'] = quote_etag(etag)
+    if timestamp is not None and not response.has_header('Last-Modified'):
+        response['Last-Modified'] = http_date(timestamp)
+    return response
+
+
+class ConditionalGetMixin(object):
+    """
+    View mixin answering conditional GET requests with 304 when the page didn't change
+    since the validators it sent, before any list query or template rendering.
+    """
+
+    def get_last_modified(self):
+        """
+        :return: datetime the page last changed at, from one cheap query, None to skip validation
+        """
+        return None
+
+    def not_modified(self):
+        """
+        Called when a request is answered with 304, for the side effects of building the page
+        """
+
+    def get(self, request, *args, **kwargs):
+        response = conditional_response(
+            request, self.get_last_modified(),
+            lambda: super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        )
+        if response.status_code == 304:
+            self.not_modified()
+        return response
@@ -1,16 +1,18 @@
 # -*- coding: utf-8 -*-
-from .models import Node
+from .node_registry import get_nodes
+from .unread import get_unread_count
+from django.utils.functional import SimpleLazyObject
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
 
 def niji_processor(request):
-    nodes = Node.objects.all()
+    nodes = SimpleLazyObject(get_nodes)
     site_name = _(getattr(settings, 'NIJI_SITE_NAME', ''))
     niji_login_url_name = getattr(settings, 'NIJI_LOGIN_URL_NAME', 'niji:login')
     niji_reg_url_name = getattr(settings, 'NIJI_REG_URL_NAME', 'niji:reg')
     try:
-        unread_count = request.user.received_notifications.filter(read=False).count()
+        unread_count = get_unread_count(request.user.pk) if request.user.is_authenticated() else None
     except AttributeError:
         unread_count = None
     return {
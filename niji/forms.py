@@ -4,6 +4,9 @@ from django.conf import settings
 from crispy_forms.layout import Submit
 from crispy_forms.helper import FormHelper
 from .models import Topic, Appendix, ForumAvatar, Post
+from .node_registry import get_node_choices
+from .avatars import get_upload_name
+from django.core.files.uploadedfile import UploadedFile
 from django.utils.translation import ugettext as _
 
 if 'pagedown' in settings.INSTALLED_APPS:
@@ -22,6 +25,8 @@ class TopicForm(ModelForm):
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop('user', None)
         super(TopicForm, self).__init__(*args, **kwargs)
+        node = self.fields['node']
+        node.choices = [('', node.empty_label)] + get_node_choices()
         self.helper = FormHelper()
         self.helper.add_input(Submit('submit', _('Submit')))
 
@@ -101,6 +106,13 @@ class ForumAvatarForm(ModelForm):
             'use_gravatar': _("Always Use Gravatar")
         }
 
+    def clean_image(self):
+        image = self.cleaned_data.get('image')
+        if isinstance(image, UploadedFile):
+            # Raises ValidationError for anything but an image in an accepted format
+            get_upload_name(image)
+        return image
+
     def save(self, commit=True):
         inst = super(ForumAvatarForm, self).save(commit=False)
         inst.user = self.user
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from niji.view_counts import get_view_count_buffer
+
+
+class Command(BaseCommand):
+    help = "Apply buffered topic views to the database"
+
+    def handle(self, *args, **options):
+        view_count_buffer = get_view_count_buffer()
+        if view_count_buffer is None:
+            self.stdout.write(self.style.ERROR("NIJI_VIEW_COUNT_BUFFER is not set, views are counted immediately"))
+            return
+        if not view_count_buffer.shared:
+            self.stdout.write(self.style.ERROR(
+                "NIJI_VIEW_COUNT_BUFFER = 'memory' buffers views in each web process, which flush them themselves"
+            ))
+            return
+        updated = view_count_buffer.flush()
+        self.stdout.write(self.style.SUCCESS('Flushed buffered views of {} topic(s)'.format(updated)))
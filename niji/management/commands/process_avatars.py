@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from niji.models import ForumAvatar
+from niji.tasks import process_avatar
+
+
+class Command(BaseCommand):
+    help = "Queue thumbnail processing of avatars without thumbnails, e.g. uploaded before they were made"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action="store_true", default=False,
+            help="Process all avatars again, e.g. after changing NIJI_AVATAR_SIZES or NIJI_AVATAR_FORMAT"
+        )
+
+    def handle(self, *args, **options):
+        avatars = ForumAvatar.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['all']:
+            avatars = avatars.filter(thumbnails='')
+        count = 0
+        for pk, image_name in avatars.order_by('pk').values_list('pk', 'image').iterator():
+            process_avatar.delay(pk, image_name)
+            count += 1
+        self.stdout.write(self.style.SUCCESS('Queued {} avatar(s)'.format(count)))
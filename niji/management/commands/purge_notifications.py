@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from niji.models import Notification
+from datetime import timedelta
+import json
+
+
+class Command(BaseCommand):
+    help = "Delete read notifications older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', action="store", type=int,
+            default=getattr(settings, 'NIJI_NOTIFICATION_RETENTION_DAYS', 90),
+            help="Keep read notifications published within this many days"
+        )
+        parser.add_argument(
+            '--chunk-size', action="store", type=int,
+            default=getattr(settings, 'NIJI_NOTIFICATION_PURGE_CHUNK_SIZE', 1000),
+            help="Number of notifications deleted per statement"
+        )
+        parser.add_argument(
+            '--sleep', action="store", type=float,
+            default=getattr(settings, 'NIJI_NOTIFICATION_PURGE_SLEEP', 0.1),
+            help="Seconds to wait between chunks"
+        )
+        parser.add_argument(
+            '--archive', action="store", default=None,
+            help="Append deleted notifications to this file, one JSON object per line"
+        )
+
+    def handle(self, *args, **options):
+        if options['days'] is None or options['days'] < 0:
+            raise CommandError("'--days' must be given and not negative")
+        if options['chunk_size'] < 1:
+            raise CommandError("'--chunk-size' must be positive")
+
+        before = timezone.now() - timedelta(days=options['days'])
+        archive_file = open(options['archive'], 'a') if options['archive'] else None
+
+        def archive(rows):
+            for row in rows:
+                archive_file.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+            archive_file.flush()
+
+        try:
+            deleted = Notification.objects.purge_read(
+                before, options['chunk_size'], options['sleep'], archive if archive_file else None
+            )
+        finally:
+            if archive_file:
+                archive_file.close()
+        self.stdout.write(self.style.SUCCESS(
+            'Deleted {} read notification(s) published before {}'.format(deleted, before)
+        ))
@@ -0,0 +1,30 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from niji.unread import rebuild_unread_counts
+
+
+class Command(BaseCommand):
+    help = "Rebuild the cached unread notification counters of all users"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', action="store", type=int, default=1000,
+            help="Number of users counted per aggregate query"
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError("'--chunk-size' must be positive")
+
+        User = get_user_model()
+        last_pk = 0
+        count = 0
+        while True:
+            user_ids = list(User.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not user_ids:
+                break
+            rebuild_unread_counts(user_ids)
+            count += len(user_ids)
+            last_pk = user_ids[-1]
+        self.stdout.write(self.style.SUCCESS('Rebuilt unread counters of {} user(s)'.format(count)))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from niji.models import Topic, Node, recount_replies, recount_nodes
+
+
+class Command(BaseCommand):
+    help = "Reconcile the reply counters of all topics, then the topic and reply counters of all nodes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', action="store", type=int, default=1000,
+            help="Number of topics recounted per aggregate query"
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError("'--chunk-size' must be positive")
+
+        last_pk = 0
+        count = 0
+        fixed = 0
+        while True:
+            topic_ids = list(Topic.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not topic_ids:
+                break
+            fixed += recount_replies(topic_ids)
+            count += len(topic_ids)
+            last_pk = topic_ids[-1]
+        self.stdout.write(self.style.SUCCESS('Recounted {} topic(s), fixed {}'.format(count, fixed)))
+        fixed = recount_nodes()
+        self.stdout.write(self.style.SUCCESS('Recounted {} node(s), fixed {}'.format(Node.objects.count(), fixed)))
@@ -1,39 +1,192 @@
 from django.core.management.base import BaseCommand, CommandError
-from niji.models import Topic, Post, render_content
+from django.db import connections, models, transaction
+from django.db.models import Case, When, Value
+from niji.models import (
+    Topic, Post, Appendix, RENDERER_VERSION, TimedOutRender, render_markdown, find_mentions, get_mention_links,
+    link_mentions, touch_topics
+)
+from niji.page_cache import bump_page_versions
+from niji.row_cache import bump_version
+from multiprocessing import Pool
+import json
 import logging
+import os
 import sys
+import xxhash
+
+# Rows written back per UPDATE statement in bulk mode
+UPDATE_BATCH_SIZE = 100
+
+
+def _render_row(row):
+    pk, content_raw, username = row
+    content_hash = xxhash.xxh64(content_raw).hexdigest()
+    mentioned = find_mentions(content_raw, username) if username is not None else set()
+    return pk, render_markdown(content_raw, content_hash), content_hash, mentioned
 
 
 class Command(BaseCommand):
-    help = "Re-render topics and posts"
+    help = "Re-render topics, posts and appendices"
 
     def add_arguments(self, parser):
         parser.add_argument('--all', action="store_true")
+        parser.add_argument(
+            '--stale', action="store_true",
+            help="Only re-render rows rendered by an older renderer version"
+        )
         parser.add_argument('--topics', action="store", nargs="+", default=[])
         parser.add_argument('--posts', action="store", nargs="+", default=[])
+        parser.add_argument(
+            '--jobs', action="store", type=int, default=0,
+            help="Render in bulk with this many processes, writing back only the rendered content"
+        )
+        parser.add_argument(
+            '--chunk-size', action="store", type=int, default=1000,
+            help="Number of rows fetched and rendered at a time in bulk mode"
+        )
+        parser.add_argument(
+            '--checkpoint', action="store", default=None,
+            help="File recording bulk mode progress, an existing checkpoint is resumed from"
+        )
 
     def handle(self, *args, **options):
         for_all = options['all']
+        stale = options['stale']
         topic_ids = options['topics']
         post_ids = options['posts']
 
-        if (not for_all) and (not topic_ids) and (not post_ids):
-            self.stdout.write(self.style.ERROR("At least one of '--all', '--topics', '--posts' is required"))
+        if (not for_all) and (not stale) and (not topic_ids) and (not post_ids):
+            self.stdout.write(self.style.ERROR("At least one of '--all', '--stale', '--topics', '--posts' is required"))
             return
 
-        if not for_all:
-            topics = Topic.objects.filter(pk__in=topic_ids).select_related('user')
-            posts = Post.objects.filter(pk__in=post_ids).select_related('user')
+        if for_all or stale:
+            topics = Topic.objects.all()
+            posts = Post.objects.all()
+            appendices = Appendix.objects.all()
+            if stale:
+                # Served by the renderer_version index
+                topics = topics.filter(renderer_version__lt=RENDERER_VERSION)
+                posts = posts.filter(renderer_version__lt=RENDERER_VERSION)
+                appendices = appendices.filter(renderer_version__lt=RENDERER_VERSION)
         else:
-            topics = Topic.objects.select_related('user').all()
-            posts = Post.objects.select_related('user').all()
+            topics = Topic.objects.filter(pk__in=topic_ids)
+            posts = Post.objects.filter(pk__in=post_ids)
+            appendices = Appendix.objects.none()
+
+        if options['jobs'] > 0:
+            return self.handle_bulk(topics, posts, appendices, options)
 
-        for topic in topics:
-            topic.content_rendered, _ = render_content(topic.content_raw, topic.user.username)
+        for topic in topics.select_related('user'):
+            content_hash = topic.get_content_hash()
+            topic.set_rendered(topic.render(content_hash)[0], content_hash)
             topic.save()
             self.stdout.write(self.style.SUCCESS('Re-rendered topic {0.id}: {0.title}'.format(topic)))
 
-        for post in posts:
-            post.content_rendered, _ = render_content(post.content_raw, post.user.username)
+        for post in posts.select_related('user'):
+            content_hash = post.get_content_hash()
+            post.set_rendered(post.render(content_hash)[0], content_hash)
             post.save()
             self.stdout.write(self.style.SUCCESS('Re-rendered post {0.id}, in topic {0.topic.id}: {0.topic.title}'.format(post)))
+
+        for appendix in appendices:
+            content_hash = appendix.get_content_hash()
+            appendix.set_rendered(appendix.render(content_hash)[0], content_hash)
+            appendix.save()
+            self.stdout.write(self.style.SUCCESS('Re-rendered appendix {0.id}, in topic {0.topic_id}'.format(appendix)))
+
+    def handle_bulk(self, topics, posts, appendices, options):
+        jobs = options['jobs']
+        chunk_size = options['chunk_size']
+        checkpoint_path = options['checkpoint']
+        if chunk_size < 1:
+            raise CommandError("'--chunk-size' must be positive")
+
+        checkpoint = {}
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            self.stdout.write('Resuming from checkpoint {}: {}'.format(checkpoint_path, checkpoint))
+
+        querysets = [
+            ('topic', topics.values_list('pk', 'content_raw', 'user__username')),
+            ('post', posts.values_list('pk', 'content_raw', 'user__username')),
+            # Appendices are not scanned for mentions
+            ('appendix', appendices.annotate(
+                no_sender=Value(None, output_field=models.CharField())
+            ).values_list('pk', 'content_raw', 'no_sender')),
+        ]
+
+        pool = None
+        if jobs > 1:
+            # Forked workers must not share the parent's database connections
+            for connection in connections.all():
+                connection.close()
+            pool = Pool(jobs)
+        try:
+            for name, queryset in querysets:
+                count = self.rerender_bulk(name, queryset, pool, chunk_size, checkpoint, checkpoint_path)
+                self.stdout.write(self.style.SUCCESS('Re-rendered {} {}(s)'.format(count, name)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def rerender_bulk(self, name, queryset, pool, chunk_size, checkpoint, checkpoint_path):
+        last_pk = checkpoint.get(name, 0)
+        count = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+            if not rows:
+                return count
+            if pool is not None:
+                results = pool.map(_render_row, rows)
+            else:
+                results = [_render_row(row) for row in rows]
+
+            links, _ = get_mention_links(set().union(*[mentioned for _, _, _, mentioned in results]))
+            rendered = [
+                (pk, link_mentions(html, dict((u, links[u]) for u in mentioned if u in links)), content_hash)
+                for pk, html, content_hash, mentioned in results
+            ]
+            # Timed out renders stay stale, to be rendered again later
+            timed_out = [pk for pk, html, _, _ in results if isinstance(html, TimedOutRender)]
+            with transaction.atomic():
+                for i in range(0, len(rendered), UPDATE_BATCH_SIZE):
+                    batch = rendered[i:i + UPDATE_BATCH_SIZE]
+                    queryset.model.objects.filter(pk__in=[pk for pk, _, _ in batch]).update(
+                        content_rendered=Case(
+                            *[When(pk=pk, then=Value(html)) for pk, html, _ in batch],
+                            output_field=models.TextField()
+                        ),
+                        rendered_hash=Case(
+                            *[When(pk=pk, then=Value(content_hash)) for pk, _, content_hash in batch],
+                            output_field=models.CharField()
+                        ),
+                        renderer_version=Case(
+                            When(pk__in=timed_out, then=Value(0)),
+                            default=Value(RENDERER_VERSION),
+                            output_field=models.PositiveSmallIntegerField()
+                        ) if timed_out else RENDERER_VERSION,
+                    )
+                # Mark the topic pages showing the content as changed, like save() does
+                if queryset.model is Topic:
+                    topic_ids = [pk for pk, _, _ in rendered]
+                else:
+                    topic_ids = sorted(set(queryset.model.objects.filter(
+                        pk__in=[pk for pk, _, _ in rendered]
+                    ).values_list('topic_id', flat=True)))
+                touch_topics(topic_ids)
+            for topic_id in topic_ids:
+                bump_version('topic', topic_id)
+            bump_page_versions(topics=topic_ids)
+
+            last_pk = rows[-1][0]
+            count += len(rows)
+            checkpoint[name] = last_pk
+            if checkpoint_path:
+                with open(checkpoint_path, 'w') as f:
+                    json.dump(checkpoint, f)
+            self.stdout.write('Re-rendered {} {}(s) up to pk {}'.format(count, name, last_pk))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import xxhash
+import re
+
+MentionedUser = namedtuple('MentionedUser', ['pk', 'username', 'url'])
+
+# Cached for usernames that don't belong to any user
+_NO_USER = ()
+# Usernames looked up per query
+_QUERY_BATCH_SIZE = 500
+
+
+def _get_cache():
+    return caches[getattr(settings, 'NIJI_MENTION_CACHE_ALIAS', 'default')]
+
+
+def _get_timeout():
+    return getattr(settings, 'NIJI_MENTION_CACHE_TIMEOUT', 300)
+
+
+def _username_key(username):
+    return 'niji:mention:%s' % xxhash.xxh64(username.encode('utf-8')).hexdigest()
+
+
+def _pk_key(pk):
+    return 'niji:mention:pk:%s' % pk
+
+
+def is_valid_username(username):
+    regex = getattr(settings, 'NIJI_MENTION_USERNAME_REGEX', r'^[\w.@+-]+$')
+    return re.match(regex, username, re.U) is not None
+
+
+def resolve_mentions(usernames):
+    """
+    Resolve mentioned usernames, remembering both hits and misses
+    :param usernames: iterable of usernames
+    :return: dict of username -> MentionedUser for the existing users
+    """
+    usernames = set(u for u in usernames if is_valid_username(u))
+    if not usernames:
+        return {}
+    cache = _get_cache()
+    keys = dict((_username_key(u), u) for u in usernames)
+    resolved = {}
+    for key, value in cache.get_many(list(keys)).items():
+        username = keys[key]
+        if value == _NO_USER:
+            usernames.discard(username)
+        elif value[1] == username:
+            resolved[username] = MentionedUser(*value)
+            usernames.discard(username)
+
+    if usernames:
+        found = {}
+        pending = list(usernames)
+        for i in range(0, len(pending), _QUERY_BATCH_SIZE):
+            for pk, username in get_user_model().objects.filter(
+                username__in=pending[i:i + _QUERY_BATCH_SIZE]
+            ).values_list('pk', 'username'):
+                found[username] = MentionedUser(pk, username, reverse('niji:user_info', kwargs={"pk": pk}))
+        to_cache = {}
+        for username in usernames:
+            user = found.get(username)
+            to_cache[_username_key(username)] = tuple(user) if user else _NO_USER
+            if user:
+                to_cache[_pk_key(user.pk)] = username
+        cache.set_many(to_cache, _get_timeout())
+        resolved.update(found)
+    return resolved
+
+
+def invalidate_user(user):
+    """
+    Forget cached lookups for a user's current and previous usernames
+    """
+    cache = _get_cache()
+    usernames = set([user.username])
+    previous = cache.get(_pk_key(user.pk))
+    if previous:
+        usernames.add(previous)
+    cache.delete_many([_username_key(u) for u in usernames] + [_pk_key(user.pk)])
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def _user_saved(sender, instance, update_fields=None, **kwargs):
+    # e.g. last_login updates on every login
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    invalidate_user(instance)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _user_deleted(sender, instance, **kwargs):
+    invalidate_user(instance)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 14:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('niji', '0005_topic_closed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appendix',
+            name='rendered_hash',
+            field=models.CharField(blank=True, default='', max_length=16, verbose_name='rendered content hash'),
+        ),
+        migrations.AddField(
+            model_name='appendix',
+            name='renderer_version',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, verbose_name='renderer version'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='rendered_hash',
+            field=models.CharField(blank=True, default='', max_length=16, verbose_name='rendered content hash'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='renderer_version',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, verbose_name='renderer version'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='rendered_hash',
+            field=models.CharField(blank=True, default='', max_length=16, verbose_name='rendered content hash'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='renderer_version',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, verbose_name='renderer version'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+# Notification.post is set for mentions in posts, Notification.topic for mentions in topics.
+# NULLs never collide in a unique index, so each case gets a partial one.
+UNIQUE_INDEXES = [
+    ('niji_notification_to_post_uniq', '(to_id, post_id) WHERE post_id IS NOT NULL'),
+    ('niji_notification_to_topic_uniq', '(to_id, topic_id) WHERE post_id IS NULL AND topic_id IS NOT NULL'),
+]
+
+
+def remove_duplicates(apps, schema_editor):
+    Notification = apps.get_model('niji', 'Notification')
+    duplicates = Notification.objects.order_by().values('to_id', 'topic_id', 'post_id').annotate(
+        keep=Min('pk'), count=Count('pk')
+    ).filter(count__gt=1)
+    for row in duplicates:
+        Notification.objects.filter(
+            to_id=row['to_id'], topic_id=row['topic_id'], post_id=row['post_id']
+        ).exclude(pk=row['keep']).delete()
+
+
+def create_unique_indexes(apps, schema_editor):
+    # Partial indexes are not supported by MySQL, the notify task checks for duplicates there
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, definition in UNIQUE_INDEXES:
+        schema_editor.execute('CREATE UNIQUE INDEX %s ON niji_notification %s' % (name, definition))
+
+
+def drop_unique_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, definition in UNIQUE_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('niji', '0006_renderer_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.RunPython(create_unique_indexes, drop_unique_indexes),
+    ]
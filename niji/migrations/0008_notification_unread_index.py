@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 17:20
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+from importlib import import_module
+
+
+def restore_unique_indexes(apps, schema_editor):
+    # SQLite rebuilds the table to change index_together, dropping the raw SQL indexes of 0007
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name, definition in import_module('niji.migrations.0007_notification_unique').UNIQUE_INDEXES:
+        schema_editor.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s ON niji_notification %s' % (name, definition))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('niji', '0007_notification_unique'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='notification',
+            index_together=set([('to', 'read', 'pub_date')]),
+        ),
+        migrations.RunPython(restore_unique_indexes, migrations.RunPython.noop),
+    ]
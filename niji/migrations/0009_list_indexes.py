@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 19:10
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# (name, table, leading equality columns, ordering columns) of each list query:
+# Index, NodeView and UserTopics in both topic orderings the views link to, and
+# the replies of TopicView. The primary key comes last as cursor pages order by it.
+# SQLite drops these when it rebuilds a table, later migrations altering niji_topic
+# or niji_post there have to create them again.
+LIST_INDEXES = [
+    ('niji_topic_list_replied', 'niji_topic', [], ['order', '-last_replied', '-id']),
+    ('niji_topic_list_pub', 'niji_topic', [], ['order', '-pub_date', '-id']),
+    ('niji_topic_node_replied', 'niji_topic', ['node_id'], ['order', '-last_replied', '-id']),
+    ('niji_topic_node_pub', 'niji_topic', ['node_id'], ['order', '-pub_date', '-id']),
+    ('niji_topic_user_pub', 'niji_topic', ['user_id'], ['order', '-pub_date', '-id']),
+    ('niji_post_topic_pub', 'niji_post', ['topic_id'], ['pub_date', 'id']),
+]
+
+
+def create_list_indexes(apps, schema_editor):
+    quote = schema_editor.quote_name
+    partial = schema_editor.connection.vendor == 'postgresql'
+    for name, table, equal, ordering in LIST_INDEXES:
+        columns = [quote(column) for column in equal]
+        if not partial:
+            # Elsewhere partial indexes are missing (MySQL) or can't be matched against
+            # the bound hidden = %s parameter (SQLite), hidden goes along instead
+            columns.append(quote('hidden'))
+        columns.extend(
+            quote(column.lstrip('-')) + (' DESC' if column.startswith('-') else '') for column in ordering
+        )
+        schema_editor.execute('CREATE INDEX %s ON %s (%s)%s' % (
+            quote(name), quote(table), ', '.join(columns), ' WHERE hidden = false' if partial else ''
+        ))
+
+
+def drop_list_indexes(apps, schema_editor):
+    for name, table, equal, ordering in LIST_INDEXES:
+        if schema_editor.connection.vendor == 'mysql':
+            schema_editor.execute('DROP INDEX %s ON %s' % (
+                schema_editor.quote_name(name), schema_editor.quote_name(table)
+            ))
+        else:
+            schema_editor.execute('DROP INDEX %s' % schema_editor.quote_name(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('niji', '0008_notification_unread_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_list_indexes, drop_list_indexes),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 20:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, When, Value, F, Count, Sum, Max
+
+
+def count_node_stats(apps, schema_editor):
+    Node = apps.get_model('niji', 'Node')
+    Topic = apps.get_model('niji', 'Topic')
+    for row in Topic.objects.order_by().values('node_id').annotate(
+        topics=Count('pk'),
+        visible_topics=Sum(Case(When(hidden=False, then=Value(1)), default=Value(0), output_field=models.IntegerField())),
+        posts=Sum('reply_count'),
+        last_activity=Max(Case(When(hidden=False, then=F('last_replied')), output_field=models.DateTimeField())),
+    ):
+        Node.objects.filter(pk=row['node_id']).update(
+            topic_count=row['topics'],
+            visible_topic_count=row['visible_topics'],
+            post_count=row['posts'],
+            last_activity=row['last_activity'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('niji', '0009_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='last activity'),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='post_count',
+            field=models.IntegerField(default=0, verbose_name='reply count'),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='topic_count',
+            field=models.IntegerField(default=0, verbose_name='topic count'),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='visible_topic_count',
+            field=models.IntegerField(default=0, verbose_name='visible topic count'),
+        ),
+        migrations.RunPython(count_node_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 20:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from importlib import import_module
+
+
+def restore_list_indexes(apps, schema_editor):
+    # SQLite rebuilds niji_topic to add or remove a column, dropping the raw SQL indexes of 0009
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    quote = schema_editor.quote_name
+    for name, table, equal, ordering in import_module('niji.migrations.0009_list_indexes').LIST_INDEXES:
+        if table != 'niji_topic':
+            continue
+        columns = [quote(column) for column in equal] + [quote('hidden')] + [
+            quote(column.lstrip('-')) + (' DESC' if column.startswith('-') else '') for column in ordering
+        ]
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+            quote(name), quote(table), ', '.join(columns)
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('niji', '0010_node_stats'),
+    ]
+
+    operations = [
+        # Reversed last, once the column is removed again
+        migrations.RunPython(migrations.RunPython.noop, restore_list_indexes),
+        migrations.AddField(
+            model_name='node',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, verbose_name='last modified time'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, verbose_name='last modified time'),
+        ),
+        migrations.RunPython(restore_list_indexes, migrations.RunPython.noop),
+    ]
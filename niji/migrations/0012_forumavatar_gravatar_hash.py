@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 21:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import hashlib
+
+
+def hash_emails(apps, schema_editor):
+    ForumAvatar = apps.get_model('niji', 'ForumAvatar')
+    for pk, email in ForumAvatar.objects.values_list('pk', 'user__email').iterator():
+        ForumAvatar.objects.filter(pk=pk).update(
+            gravatar_hash=hashlib.md5((email or '').strip().lower().encode('utf-8')).hexdigest()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('niji', '0011_last_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forumavatar',
+            name='gravatar_hash',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.RunPython(hash_emails, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 21:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('niji', '0012_forumavatar_gravatar_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forumavatar',
+            name='thumbnails',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
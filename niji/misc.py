@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 from django.db.models import Q
+from contextlib import contextmanager
+import logging
 import re
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+_warned_not_main_thread = False
 
 
 def normalize_query(query_string,
@@ -24,4 +31,48 @@ def get_query(query_string, search_fields):
             query = or_query
         else:
             query = query & or_query
-    return query
\ No newline at end of file
+    return query
+
+
+def _in_main_thread():
+    if hasattr(threading, 'main_thread'):
+        return threading.current_thread() is threading.main_thread()
+    # Python 2 has no threading.main_thread
+    return threading.current_thread().name == 'MainThread'
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+@contextmanager
+def time_limit(seconds):
+    """
+    Raise TimeLimitExceeded if the block runs longer than ``seconds``.
+    Relies on SIGALRM, so it is a no-op outside the main thread or on platforms without it,
+    which is logged once.
+    """
+    global _warned_not_main_thread
+    if not seconds:
+        yield
+        return
+    if not hasattr(signal, 'setitimer') or not _in_main_thread():
+        if not _warned_not_main_thread:
+            _warned_not_main_thread = True
+            logger.warning(
+                'Time limits need SIGALRM in the main thread, not enforced in thread "%s"',
+                threading.current_thread().name
+            )
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TimeLimitExceeded()
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
@@ -1,56 +1,336 @@
 # -*- coding: utf-8 -*-
 from django.db import models
-from django.db.models import F
-from django.contrib.auth import get_user_model
+from django.db.models import F, Q, Case, When, Value, Count, Max, Sum
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.conf import settings
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.html import linebreaks
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext as _
+from collections import Counter
 from functools import partial
-from niji.tasks import notify
-from PIL import Image
-from io import BytesIO
+from niji.tasks import notify, render, process_avatar
+from niji.render_cache import get_render_cache
+from niji.mentions import resolve_mentions
+from niji.misc import time_limit, TimeLimitExceeded
+from niji.signals import render_guard_tripped
+from niji.view_counts import get_view_count_buffer
+from niji.unread import add_unread
+from niji.row_cache import bump_version
+from niji.page_cache import bump_page_versions, page_cache_enabled
+from niji.node_registry import invalidate_node_registry
+from niji.avatars import gravatar_hash, invalidate_avatar, get_upload_name
+import json
 import xxhash
 import mistune
+import logging
 import re
+import time
 import six
+import threading
 if six.PY2:
     import sys
     reload(sys)
     sys.setdefaultencoding('utf-8')
 
 
+# Longest username Django allows, also bounds the scan after each @ sign
+MAX_USERNAME_LENGTH = 150
 MENTION_REGEX = re.compile(r'@(\S+)', re.M)
+MENTION_LINK_REGEX = re.compile(
+    r'@(?P<username>\S{1,%d}?)(?P<whitespace>\s|</p>)' % MAX_USERNAME_LENGTH, re.M
+)
 USER_MODEL = settings.AUTH_USER_MODEL
+# Bump this whenever markdown or mention rendering output changes
+RENDERER_VERSION = 1
 
 
-def _replace_username(link, matchobj):
+logger = logging.getLogger(__name__)
+# Ids of the topics being deleted in this thread, their replies are taken off the counters with them
+_deleting_topics = threading.local()
+
+
+def _guard_tripped(guard, content_raw):
+    logger.warning('Render guard "%s" tripped on %d characters of content', guard, len(content_raw))
+    render_guard_tripped.send(sender=None, guard=guard, content_length=len(content_raw))
+
+
+def render_plain(content_raw):
+    """
+    Escaped raw content with line breaks, used whenever markdown isn't rendered
+    """
+    return linebreaks(content_raw, autoescape=True)
+
+
+def _replace_username(links, matchobj):
+    username = matchobj.group("username")
+    link = links.get(username)
+    if link is None:
+        return matchobj.group(0)
     return "@<a href=\"{link}\">{username}</a>{whitespace}".format(
-        username=matchobj.group("username")[1:],
+        username=username,
         whitespace=matchobj.group("whitespace"),
         link=link
     )
 
 
-def render_content(content_raw, sender):
+def link_mentions(content_rendered, links):
+    """
+    Link all mentions in a single pass over the rendered content
+    :param content_rendered: Rendered content
+    :param links: dict of username -> user url
+    :return: rendered content with mentions linked
+    """
+    if not links:
+        return content_rendered
+    return MENTION_LINK_REGEX.sub(partial(_replace_username, links), content_rendered)
+
+
+def async_render_enabled():
+    return getattr(settings, 'NIJI_ASYNC_RENDER', False) and not getattr(settings, 'CELERY_ALWAYS_EAGER', False)
+
+
+def _on_commit(func):
+    # transaction.on_commit is not available before Django 1.9
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+class TimedOutRender(six.text_type):
+    """
+    Plain text shown for content whose rendering ran over NIJI_RENDER_TIME_LIMIT.
+    It is never cached and is saved as stale, so the content is rendered again later.
+    """
+
+
+def _render_markdown_timed(content_raw):
+    with time_limit(getattr(settings, 'NIJI_RENDER_TIME_LIMIT', 2)):
+        return mistune.markdown(content_raw)
+
+
+def render_markdown(content_raw, content_hash=None):
+    """
+    Render markdown through the render cache, falling back to plain text
+    for content over NIJI_RENDER_MAX_LENGTH or taking over NIJI_RENDER_TIME_LIMIT
+    :param content_raw: Raw content
+    :param content_hash: xxh64 hexdigest of content_raw, computed if not given
+    :return: rendered content
+    """
+    if len(content_raw) > getattr(settings, 'NIJI_RENDER_MAX_LENGTH', 100000):
+        _guard_tripped('length', content_raw)
+        return render_plain(content_raw)
+    if content_hash is None:
+        content_hash = xxhash.xxh64(content_raw).hexdigest()
+    try:
+        # Raising leaves nothing in the render cache
+        return get_render_cache().get_or_render(
+            '%s:%s' % (RENDERER_VERSION, content_hash),
+            partial(_render_markdown_timed, content_raw)
+        )
+    except TimeLimitExceeded:
+        _guard_tripped('time', content_raw)
+        return TimedOutRender(render_plain(content_raw))
+
+
+def find_mentions(content_raw, sender):
+    """
+    :param content_raw: Raw content
+    :param sender: user as username
+    :return: set of at most NIJI_MAX_MENTIONS mentioned usernames, excluding the sender
+    """
+    max_mentions = getattr(settings, 'NIJI_MAX_MENTIONS', 50)
+    mentioned = set()
+    for username in MENTION_REGEX.findall(content_raw):
+        if len(username) > MAX_USERNAME_LENGTH or username == sender:
+            continue
+        if len(mentioned) >= max_mentions and username not in mentioned:
+            _guard_tripped('mentions', content_raw)
+            break
+        mentioned.add(username)
+    return mentioned
+
+
+def get_mention_links(usernames):
+    """
+    Resolve usernames through the mention cache
+    :param usernames: iterable of usernames
+    :return: (dict of username -> user url, list of MentionedUser)
+    """
+    mentioned = resolve_mentions(usernames)
+    links = dict((username, user.url) for username, user in mentioned.items())
+    return links, list(mentioned.values())
+
+
+def render_content(content_raw, sender, content_hash=None):
     """
     :param content_raw: Raw content
     :param sender: user as username
+    :param content_hash: xxh64 hexdigest of content_raw, computed if not given
     :return: (rendered_content, mentioned_user_list)
     """
-    content_rendered = mistune.markdown(content_raw)
-    mentioned = list(set(re.findall(MENTION_REGEX, content_raw)))
-    mentioned = [x for x in mentioned if x != sender]
-    mentioned_users = get_user_model().objects.filter(username__in=mentioned)
-    for user in mentioned_users:
-        content_rendered = re.sub(
-            r'(?P<username>@%s)(?P<whitespace>\s|<\/p>)' % user.username,
-            partial(_replace_username, reverse('niji:user_info', kwargs={"pk": user.pk})),
-            content_rendered,
-            re.M
+    content_rendered = render_markdown(content_raw, content_hash)
+    links, mentioned_users = get_mention_links(find_mentions(content_raw, sender))
+    linked = link_mentions(content_rendered, links)
+    if isinstance(content_rendered, TimedOutRender):
+        linked = TimedOutRender(linked)
+    return linked, mentioned_users
+
+
+class RenderedContentModel(models.Model):
+    """
+    Abstract base for models rendering ``content_raw`` into ``content_rendered``,
+    recording which renderer version and source hash the rendered content is from.
+    """
+    renderer_version = models.PositiveSmallIntegerField(default=0, db_index=True, verbose_name=_("renderer version"))
+    rendered_hash = models.CharField(max_length=16, default='', blank=True, verbose_name=_("rendered content hash"))
+
+    # content_raw as loaded or last saved, kept by reference and only hashed on demand
+    _original_content_raw = None
+    _content_hash = None
+    # Set when rendering was deferred to a task, dispatched once saved
+    _pending_render = None
+
+    class Meta:
+        abstract = True
+
+    def __init__(self, *args, **kwargs):
+        super(RenderedContentModel, self).__init__(*args, **kwargs)
+        # Deferred fields are missing from __dict__, don't force loading them
+        self._original_content_raw = self.__dict__.get('content_raw')
+
+    def _hash(self, content_raw):
+        cached = self._content_hash
+        if cached is None or cached[0] is not content_raw:
+            cached = self._content_hash = (content_raw, xxhash.xxh64(content_raw).hexdigest())
+        return cached[1]
+
+    @property
+    def raw_content_hash(self):
+        if self._original_content_raw is None:
+            return None
+        return self._hash(self._original_content_raw)
+
+    def get_content_hash(self):
+        return self._hash(self.content_raw)
+
+    def content_changed(self):
+        if not self.pk:
+            return True
+        if 'content_raw' not in self.__dict__:
+            # Deferred and never assigned
+            return False
+        content_raw = self.content_raw
+        original = self._original_content_raw
+        if original is not None:
+            return content_raw is not original and content_raw != original
+        # Assigned after a deferred load, compare with what was rendered
+        return self._hash(content_raw) != self.rendered_hash
+
+    def render_if_needed(self, update_fields=None):
+        """
+        Re-render if content_raw changed, or if it was rendered by an older renderer
+        :param update_fields: update_fields passed to save
+        :return: users mentioned in the changed content
+        """
+        changed = self.content_changed()
+        if not changed and not (
+            update_fields is None and 'content_raw' in self.__dict__ and self.is_render_stale()
+        ):
+            return []
+        content_hash = self.get_content_hash()
+        if async_render_enabled():
+            # Show escaped raw content until the task has rendered it
+            self.content_rendered = render_plain(self.content_raw)
+            self.renderer_version = 0
+            self._pending_render = changed
+            return []
+        content_rendered, mentioned_users = self.render(content_hash)
+        self.set_rendered(content_rendered, content_hash)
+        return mentioned_users if changed else []
+
+    def save(self, *args, **kwargs):
+        super(RenderedContentModel, self).save(*args, **kwargs)
+        self._original_content_raw = self.__dict__.get('content_raw')
+        if self._pending_render is not None:
+            self.schedule_render(notify_mentions=self._pending_render)
+            self._pending_render = None
+
+    def schedule_render(self, notify_mentions=False):
+        """
+        Render in a ``niji.tasks.render`` task once the current transaction commits
+        :param notify_mentions: notify mentioned users after rendering
+        """
+        content_hash = self.get_content_hash()
+        model_name = self._meta.model_name
+        if not notify_mentions:
+            # Skip if the same content is already queued, e.g. from rerender_if_stale on a busy page
+            key = 'niji:render-scheduled:%s:%s:%s' % (model_name, self.pk, content_hash)
+            if not cache.add(key, True, 60):
+                return
+        _on_commit(partial(render.delay, model_name, self.pk, content_hash, notify_mentions))
+
+    def notify_mentioned(self, mentioned_users):
+        """
+        :param mentioned_users: users mentioned in newly saved content
+        """
+
+    def render(self, content_hash=None):
+        """
+        :param content_hash: xxh64 hexdigest of content_raw, computed if not given
+        :return: (rendered_content, mentioned_user_list)
+        """
+        raise NotImplementedError
+
+    def set_rendered(self, content_rendered, content_hash):
+        self.content_rendered = content_rendered
+        # A timed out render is saved as stale, for rerender_if_stale and ``rerender --stale``
+        self.renderer_version = 0 if isinstance(content_rendered, TimedOutRender) else RENDERER_VERSION
+        self.rendered_hash = content_hash
+
+    def is_render_stale(self):
+        return self.renderer_version != RENDERER_VERSION
+
+    def get_topic_id(self):
+        """
+        :return: id of the topic whose page shows the content
+        """
+        raise NotImplementedError
+
+    def save_rendered(self):
+        """
+        Store the rendered content with one UPDATE, without the side effects of ``save``
+        other than marking the topic page as changed for validators and cached pages
+        """
+        type(self).objects.filter(pk=self.pk).update(
+            content_rendered=self.content_rendered,
+            renderer_version=self.renderer_version,
+            rendered_hash=self.rendered_hash,
         )
-    return content_rendered, mentioned_users
+        topic_id = self.get_topic_id()
+        touch_topics([topic_id])
+        bump_version('topic', topic_id)
+        bump_page_versions(topics=[topic_id])
+
+    def rerender_if_stale(self):
+        """
+        Re-render and store content rendered by an older renderer version,
+        without any of the side effects of ``save``
+        :return: whether the content was re-rendered
+        """
+        if not self.is_render_stale():
+            return False
+        if async_render_enabled():
+            self.schedule_render()
+            return False
+        content_hash = self.get_content_hash()
+        self.set_rendered(self.render(content_hash)[0], content_hash)
+        self.save_rendered()
+        return True
 
 
 class TopicQueryset(models.QuerySet):
@@ -58,9 +338,15 @@ class TopicQueryset(models.QuerySet):
     def visible(self):
         return self.filter(hidden=False)
 
+    def for_page(self):
+        """
+        Topics joined with the node, author and avatar shown along with them on the topic page
+        """
+        return self.select_related('node', 'user', 'user__forum_avatar')
+
 
 @python_2_unicode_compatible
-class Topic(models.Model):
+class Topic(RenderedContentModel):
     user = models.ForeignKey(USER_MODEL, related_name='topics', verbose_name=_("user"))
     title = models.CharField(max_length=120, verbose_name=_("title"))
     content_raw = models.TextField(verbose_name=_("raw content"))
@@ -70,16 +356,18 @@ class Topic(models.Model):
     node = models.ForeignKey('Node', related_name='topics', verbose_name=_("node"))
     pub_date = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name=_("published time"))
     last_replied = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name=_("last replied time"))
+    # Anything shown on the topic page changed, maintained by Post and Appendix too
+    last_modified = models.DateTimeField(auto_now=True, verbose_name=_("last modified time"))
     order = models.IntegerField(default=10, verbose_name=_("order"))
     hidden = models.BooleanField(default=False, verbose_name=_("hidden"))
     closed = models.BooleanField(default=False, verbose_name=_("closed"))
     objects = TopicQueryset.as_manager()
 
-    raw_content_hash = None
-
     def __init__(self, *args, **kwargs):
         super(Topic, self).__init__(*args, **kwargs)
-        self.raw_content_hash = xxhash.xxh64(self.content_raw).hexdigest()
+        # Visibility and node as last saved, to tell what the node counters need
+        self._original_hidden = self.__dict__.get('hidden')
+        self._original_node_id = self.__dict__.get('node_id')
 
     def get_reply_count(self):
         return self.replies.visible().count()
@@ -91,18 +379,57 @@ class Topic(models.Model):
         return self.pub_date
 
     def increase_view_count(self):
-        Topic.objects.filter(pk=self.id).update(view_count=F('view_count') + 1)
+        view_count_buffer = get_view_count_buffer()
+        if view_count_buffer is not None:
+            view_count_buffer.add(self.id)
+        else:
+            Topic.objects.filter(pk=self.id).update(view_count=F('view_count') + 1)
+
+    def get_topic_id(self):
+        return self.pk
+
+    def render(self, content_hash=None):
+        return render_content(self.content_raw, sender=self.user.username, content_hash=content_hash)
 
     def save(self, *args, **kwargs):
-        new_hash = xxhash.xxh64(self.content_raw).hexdigest()
-        mentioned_users = []
-        if new_hash != self.raw_content_hash or (not self.pk):
-            # To (re-)render the content if content changed or topic is newly created
-            self.content_rendered, mentioned_users = render_content(self.content_raw, sender=self.user.username)
+        # To (re-)render the content if content changed or topic is newly created
+        mentioned_users = self.render_if_needed(kwargs.get('update_fields'))
+        # Node counters are updated by the post_save receiver, which knows whether a row was inserted
         super(Topic, self).save(*args, **kwargs)
-        self.raw_content_hash = new_hash
-        for to in mentioned_users:
-                notify.delay(to=to.username, sender=self.user.username, topic=self.pk)
+        self._original_hidden = self.hidden
+        self._original_node_id = self.node_id
+        self.notify_mentioned(mentioned_users)
+
+    def notify_mentioned(self, mentioned_users):
+        if mentioned_users:
+            notify.delay(sender=self.user_id, to=[to.pk for to in mentioned_users], topic=self.pk)
+
+    def update_node_stats(self, created=False, deleted=False):
+        """
+        Apply this topic's change to the counters of its node(s) with F-expression deltas,
+        finding the latest activity again only when it may have come from this topic
+        :param created: the topic was just inserted
+        :param deleted: the topic was just deleted
+        """
+        original_hidden = self.hidden if self._original_hidden is None else self._original_hidden
+        original_node_id = self._original_node_id or self.node_id
+        was_visible = not created and not original_hidden
+        is_visible = not deleted and not self.hidden
+        now = timezone.now()
+        if not created and not deleted and was_visible == is_visible and original_node_id == self.node_id:
+            Node.objects.filter(pk=self.node_id).update_stats(modified=now)
+            return
+        if not created:
+            Node.objects.filter(pk=original_node_id).update_stats(
+                topics=-1, visible_topics=-int(was_visible), posts=-self.reply_count, modified=now
+            )
+            if was_visible:
+                recount_last_activity(original_node_id, self.last_replied)
+        if not deleted:
+            Node.objects.filter(pk=self.node_id).update_stats(
+                topics=1, visible_topics=int(is_visible), posts=self.reply_count,
+                activity=self.last_replied if is_visible else None, modified=now
+            )
 
     class Meta:
         ordering = ['order', '-pub_date']
@@ -111,6 +438,34 @@ class Topic(models.Model):
         return self.title
 
 
+@receiver(post_save, sender=Topic)
+def _topic_saved(sender, instance, created, raw=False, **kwargs):
+    bump_version('topic', instance.pk)
+    bump_page_versions(topics=[instance.pk], nodes=set([instance._original_node_id, instance.node_id]))
+    # Fixtures carry their own counters
+    if not raw:
+        instance.update_node_stats(created=created)
+
+
+def _get_deleting_topics():
+    if not hasattr(_deleting_topics, 'ids'):
+        _deleting_topics.ids = set()
+    return _deleting_topics.ids
+
+
+@receiver(pre_delete, sender=Topic)
+def _topic_deleting(sender, instance, **kwargs):
+    _get_deleting_topics().add(instance.pk)
+
+
+@receiver(post_delete, sender=Topic)
+def _topic_deleted(sender, instance, **kwargs):
+    # Also sent for topics deleted in bulk, e.g. from the admin
+    _get_deleting_topics().discard(instance.pk)
+    instance.update_node_stats(deleted=True)
+    bump_page_versions(topics=[instance.pk], nodes=[instance.node_id])
+
+
 class PostQueryset(models.QuerySet):
 
     use_for_related_fields = True
@@ -120,7 +475,7 @@ class PostQueryset(models.QuerySet):
 
 
 @python_2_unicode_compatible
-class Post(models.Model):
+class Post(RenderedContentModel):
     topic = models.ForeignKey('Topic', related_name='replies', verbose_name=_("topic"))
     user = models.ForeignKey(USER_MODEL, related_name='posts', verbose_name=_("user"))
     content_raw = models.TextField(verbose_name=_("raw content"))
@@ -129,34 +484,244 @@ class Post(models.Model):
     hidden = models.BooleanField(default=False, verbose_name=_("hidden"))
     objects = PostQueryset.as_manager()
 
-    raw_content_hash = None
+    def __str__(self):
+        return 'Reply to %s' % self.topic.title
+
+    def get_topic_id(self):
+        return self.topic_id
+
+    def render(self, content_hash=None):
+        return render_content(self.content_raw, sender=self.user.username, content_hash=content_hash)
 
     def __init__(self, *args, **kwargs):
         super(Post, self).__init__(*args, **kwargs)
-        self.raw_content_hash = xxhash.xxh64(self.content_raw).hexdigest()
-
-    def __str__(self):
-        return 'Reply to %s' % self.topic.title
+        # Visibility and topic as last saved, to tell what the topic counters need
+        self._original_hidden = self.__dict__.get('hidden')
+        self._original_topic_id = self.__dict__.get('topic_id')
 
     def save(self, *args, **kwargs):
-        new_hash = xxhash.xxh64(self.content_raw).hexdigest()
-        mentioned_users = []
-        if new_hash != self.raw_content_hash or (not self.pk):
-            self.content_rendered, mentioned_users = render_content(self.content_raw, sender=self.user.username)
+        mentioned_users = self.render_if_needed(kwargs.get('update_fields'))
+        # Topic counters are updated by the post_save receiver, which knows whether a row was inserted
         super(Post, self).save(*args, **kwargs)
-        t = self.topic
-        t.reply_count = t.get_reply_count()
-        t.last_replied = t.get_last_replied()
-        t.save(update_fields=['last_replied', 'reply_count'])
-        for to in mentioned_users:
-            notify.delay(to=to.username, sender=self.user.username, post=self.pk)
+        self._original_hidden = self.hidden
+        self._original_topic_id = self.topic_id
+        self.notify_mentioned(mentioned_users)
+
+    def notify_mentioned(self, mentioned_users):
+        if mentioned_users:
+            notify.delay(sender=self.user_id, to=[to.pk for to in mentioned_users], post=self.pk)
+
+    def update_topic_stats(self, created=False, deleted=False):
+        """
+        Apply this reply's change to reply_count and last_replied of its topic(s) with F-expression deltas,
+        counting from scratch only when it may have been the latest visible reply
+        :param created: the reply was just inserted
+        :param deleted: the reply was just deleted
+        """
+        original_hidden = self.hidden if self._original_hidden is None else self._original_hidden
+        original_topic_id = self._original_topic_id or self.topic_id
+        was_visible = not created and not original_hidden
+        is_visible = not deleted and not self.hidden
+        now = timezone.now()
+        if was_visible == is_visible and original_topic_id == self.topic_id:
+            touch_topics([self.topic_id], now)
+            return
+        if was_visible:
+            Topic.objects.filter(pk=original_topic_id).update(reply_count=F('reply_count') - 1, last_modified=now)
+            Node.objects.filter(topics=original_topic_id).update_stats(posts=-1, modified=now)
+            if Topic.objects.filter(pk=original_topic_id, last_replied__lte=self.pub_date).exists():
+                recount_replies([original_topic_id])
+                # It may have been the node's latest activity as well
+                node_id = Topic.objects.visible().filter(pk=original_topic_id).values_list(
+                    'node_id', flat=True
+                ).first()
+                if node_id is not None:
+                    recount_last_activity(node_id, self.pub_date)
+        if is_visible:
+            Node.objects.filter(topics=self.topic_id).update_stats(posts=1, activity=self.pub_date, modified=now)
+            Topic.objects.filter(pk=self.topic_id).update(
+                reply_count=F('reply_count') + 1,
+                last_modified=now,
+                last_replied=Case(
+                    When(last_replied__lt=self.pub_date, then=Value(self.pub_date)),
+                    default=F('last_replied'),
+                    output_field=models.DateTimeField()
+                )
+            )
+        # Keep a topic instance this reply was saved through in sync
+        topic = getattr(self, self._meta.get_field('topic').get_cache_name(), None)
+        if topic is not None and topic.pk in (original_topic_id, self.topic_id):
+            topic.refresh_from_db(fields=['reply_count', 'last_replied', 'last_modified'])
+
+
+@receiver(post_save, sender=Post)
+def _post_saved(sender, instance, created, raw=False, **kwargs):
+    # Fixtures carry their own counters
+    if not raw:
+        instance.update_topic_stats(created=created)
+    _bump_reply_pages(instance)
+
+
+@receiver(post_delete, sender=Post)
+def _post_deleted(sender, instance, **kwargs):
+    # Also sent for replies deleted in bulk, e.g. from the admin. Replies deleted along
+    # with their topic are deleted first, the topic's own deletion takes them off the node.
+    if instance.topic_id not in _get_deleting_topics():
+        instance.update_topic_stats(deleted=True)
+    _bump_reply_pages(instance)
+
+
+def _bump_reply_pages(post):
+    # Reply counts show on the topic lists of the node
+    if page_cache_enabled():
+        topic_ids = set([post._original_topic_id or post.topic_id, post.topic_id])
+        bump_page_versions(
+            topics=topic_ids,
+            nodes=Topic.objects.filter(pk__in=topic_ids).values_list('node_id', flat=True)
+        )
+
+
+def touch_topics(topic_ids, now=None):
+    """
+    Mark topics as modified by a change only shown on the topic page, e.g. an edited reply
+    """
+    Topic.objects.filter(pk__in=topic_ids).update(last_modified=now or timezone.now())
+
+
+def recount_last_activity(node_id, removed_activity):
+    """
+    Find the latest activity of a node again if it may have been the removed one
+    :param removed_activity: last_replied of a topic, or pub_date of a reply, no longer shown on the node
+    """
+    if Node.objects.filter(pk=node_id, last_activity__lte=removed_activity).exists():
+        Node.objects.filter(pk=node_id).update(
+            last_activity=Topic.objects.visible().filter(node_id=node_id).aggregate(last=Max('last_replied'))['last']
+        )
+
+
+def recount_replies(topic_ids):
+    """
+    Recount reply_count and last_replied of topics from their visible replies with one grouped aggregate
+    :param topic_ids: list of topic ids
+    :return: number of topics whose counters were off
+    """
+    stats = dict(
+        (row['topic_id'], (row['count'], row['last']))
+        for row in Post.objects.visible().filter(topic_id__in=topic_ids).order_by().values('topic_id').annotate(
+            count=Count('pk'), last=Max('pub_date')
+        )
+    )
+    wrong = [
+        (pk, stats.get(pk, (0, pub_date))) for pk, reply_count, last_replied, pub_date in
+        Topic.objects.filter(pk__in=topic_ids).values_list('pk', 'reply_count', 'last_replied', 'pub_date')
+        if stats.get(pk, (0, pub_date)) != (reply_count, last_replied)
+    ]
+    if wrong:
+        Topic.objects.filter(pk__in=[pk for pk, stat in wrong]).update(
+            reply_count=Case(
+                *[When(pk=pk, then=Value(count)) for pk, (count, last) in wrong],
+                output_field=models.IntegerField()
+            ),
+            last_replied=Case(
+                *[When(pk=pk, then=Value(last)) for pk, (count, last) in wrong],
+                output_field=models.DateTimeField()
+            ),
+            last_modified=timezone.now(),
+        )
+        for pk, stat in wrong:
+            bump_version('topic', pk)
+        bump_page_versions(topics=[pk for pk, stat in wrong])
+    return len(wrong)
 
-    def delete(self, *args, **kwargs):
-        super(Post, self).delete(*args, **kwargs)
-        t = self.topic
-        t.reply_count = t.get_reply_count()
-        t.last_replied = t.get_last_replied()
-        t.save(update_fields=['last_replied', 'reply_count'])
+
+def recount_nodes():
+    """
+    Recount the counters of all nodes from their topics with one grouped aggregate,
+    reply counts are taken from the topics so recount those first
+    :return: number of nodes whose counters were off
+    """
+    stats = dict(
+        (row['node_id'], (row['topics'], row['visible_topics'], row['posts'], row['last_activity']))
+        for row in Topic.objects.order_by().values('node_id').annotate(
+            topics=Count('pk'),
+            visible_topics=Sum(Case(When(hidden=False, then=Value(1)), default=Value(0), output_field=models.IntegerField())),
+            posts=Sum('reply_count'),
+            last_activity=Max(Case(When(hidden=False, then=F('last_replied')), output_field=models.DateTimeField())),
+        )
+    )
+    wrong = [
+        (row[0], stats.get(row[0], (0, 0, 0, None))) for row in
+        Node.objects.values_list('pk', 'topic_count', 'visible_topic_count', 'post_count', 'last_activity')
+        if stats.get(row[0], (0, 0, 0, None)) != tuple(row[1:])
+    ]
+    now = timezone.now()
+    for pk, (topics, visible_topics, posts, last_activity) in wrong:
+        Node.objects.filter(pk=pk).update(
+            topic_count=topics, visible_topic_count=visible_topics, post_count=posts, last_activity=last_activity,
+            last_modified=now
+        )
+    if wrong:
+        invalidate_node_registry()
+        bump_page_versions(nodes=[pk for pk, stats in wrong])
+    return len(wrong)
+
+
+class NotificationQueryset(models.QuerySet):
+
+    def bulk_create_unique(self, notifications):
+        """
+        Insert notifications with one statement, dropping those a unique index rejects
+        :param notifications: list of unsaved notifications
+        :return: number of notifications created
+        """
+        if not notifications:
+            return 0
+        try:
+            with transaction.atomic():
+                self.bulk_create(notifications)
+        except IntegrityError:
+            # Some were created concurrently, insert one by one to keep the rest, counted by _notification_saved
+            created = 0
+            for notification in notifications:
+                try:
+                    with transaction.atomic():
+                        notification.save(force_insert=True)
+                    created += 1
+                except IntegrityError:
+                    pass
+            return created
+        # bulk_create sends no post_save
+        add_unread(Counter(notification.to_id for notification in notifications if not notification.read))
+        return len(notifications)
+
+    def purge_read(self, before, chunk_size=1000, sleep=0, archive=None):
+        """
+        Delete read notifications in primary key ordered chunks, each one a short DELETE
+        :param before: datetime, notifications published before it are deleted
+        :param chunk_size: notifications deleted per statement
+        :param sleep: seconds to wait between chunks
+        :param archive: callable taking each chunk as a list of dicts before it is deleted
+        :return: number of notifications deleted
+        """
+        queryset = self.filter(read=True, pub_date__lt=before).order_by('pk')
+        last_pk = 0
+        deleted = 0
+        while True:
+            if archive is not None:
+                rows = list(queryset.filter(pk__gt=last_pk).values()[:chunk_size])
+                pks = [row[self.model._meta.pk.attname] for row in rows]
+            else:
+                pks = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return deleted
+            if archive is not None:
+                archive(rows)
+            deleted += self.filter(pk__in=pks).delete()[0]
+            last_pk = pks[-1]
+            if len(pks) < chunk_size:
+                return deleted
+            if sleep:
+                time.sleep(sleep)
 
 
 @python_2_unicode_compatible
@@ -167,39 +732,88 @@ class Notification(models.Model):
     post = models.ForeignKey('Post', null=True, verbose_name=_("reply"))
     read = models.BooleanField(default=False, verbose_name=_("read"))
     pub_date = models.DateTimeField(auto_now_add=True, verbose_name=_("published time"))
+    # A user is notified once per topic or post, see migration 0007 for the unique indexes
+    objects = NotificationQueryset.as_manager()
+
+    class Meta:
+        # Unread notifications of a user, newest first
+        index_together = [('to', 'read', 'pub_date')]
 
     def __str__(self):
         return 'Notification from %s to %s' % (self.sender.username, self.to.username)
 
 
+@receiver(post_save, sender=Notification)
+def _notification_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and not instance.read:
+        add_unread({instance.to_id: 1})
+
+
 @python_2_unicode_compatible
-class Appendix(models.Model):
+class Appendix(RenderedContentModel):
     topic = models.ForeignKey('Topic', verbose_name=_("topic"))
     pub_date = models.DateTimeField(auto_now_add=True, verbose_name=_("published time"))
     content_raw = models.TextField(verbose_name=_("raw content"))
     content_rendered = models.TextField(default='', blank=True, verbose_name=_("rendered content"))
 
-    raw_content_hash = None
+    def get_topic_id(self):
+        return self.topic_id
 
-    def __init__(self, *args, **kwargs):
-        super(Appendix, self).__init__(*args, **kwargs)
-        self.raw_content_hash = xxhash.xxh64(self.content_raw).hexdigest()
+    def render(self, content_hash=None):
+        return render_markdown(self.content_raw, content_hash), []
 
     def save(self, *args, **kwargs):
-        new_hash = xxhash.xxh64(self.content_raw).hexdigest()
-        if new_hash != self.raw_content_hash or (not self.pk):
-            self.content_rendered = mistune.markdown(self.content_raw)
+        self.render_if_needed(kwargs.get('update_fields'))
         super(Appendix, self).save(*args, **kwargs)
-        self.raw_content_hash = new_hash
+        touch_topics([self.topic_id])
+        bump_page_versions(topics=[self.topic_id])
 
     def __str__(self):
         return 'Appendix to %s' % self.topic.title
 
 
+class NodeQueryset(models.QuerySet):
+
+    def update_stats(self, topics=0, visible_topics=0, posts=0, activity=None, modified=None):
+        """
+        Add to the counters of the nodes with one UPDATE
+        :param topics: topics added
+        :param visible_topics: visible topics added
+        :param posts: visible replies added
+        :param activity: datetime of new activity, kept if later than last_activity
+        :param modified: datetime the topics of the nodes were changed at
+        """
+        changes = {}
+        if topics:
+            changes['topic_count'] = F('topic_count') + topics
+        if visible_topics:
+            changes['visible_topic_count'] = F('visible_topic_count') + visible_topics
+        if posts:
+            changes['post_count'] = F('post_count') + posts
+        if activity is not None:
+            changes['last_activity'] = Case(
+                When(Q(last_activity__isnull=True) | Q(last_activity__lt=activity), then=Value(activity)),
+                default=F('last_activity'),
+                output_field=models.DateTimeField()
+            )
+        if modified is not None:
+            changes['last_modified'] = modified
+        if changes:
+            self.update(**changes)
+
+
 @python_2_unicode_compatible
 class Node(models.Model):
     title = models.CharField(max_length=30, verbose_name=_("title"))
     description = models.TextField(default='', blank=True, verbose_name=_("description"))
+    # Maintained by Topic and Post, reconciled by the recount command
+    topic_count = models.IntegerField(default=0, verbose_name=_("topic count"))
+    visible_topic_count = models.IntegerField(default=0, verbose_name=_("visible topic count"))
+    post_count = models.IntegerField(default=0, verbose_name=_("reply count"))
+    last_activity = models.DateTimeField(null=True, blank=True, verbose_name=_("last activity"))
+    # The node or any of its topics changed
+    last_modified = models.DateTimeField(auto_now=True, verbose_name=_("last modified time"))
+    objects = NodeQueryset.as_manager()
 
     def __str__(self):
         return self.title
@@ -214,6 +828,17 @@ class NodeGroup(models.Model):
         return self.title
 
 
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+@receiver(post_save, sender=NodeGroup)
+@receiver(post_delete, sender=NodeGroup)
+@receiver(m2m_changed, sender=NodeGroup.node.through)
+def _node_changed(sender, **kwargs):
+    # Node titles show on every page
+    invalidate_node_registry()
+    bump_page_versions(site=True)
+
+
 @python_2_unicode_compatible
 class ForumAvatar(models.Model):
     user = models.OneToOneField(USER_MODEL, related_name='forum_avatar')
@@ -223,23 +848,101 @@ class ForumAvatar(models.Model):
                               blank=True,
                               default="",
                               null=True)
+    # Kept in sync with the user's email, so pages don't hash it for every avatar shown
+    gravatar_hash = models.CharField(max_length=32, blank=True, default='')
+    # JSON object of size -> name of the thumbnails made by niji.tasks.process_avatar
+    thumbnails = models.TextField(blank=True, default='')
+
+    def __init__(self, *args, **kwargs):
+        super(ForumAvatar, self).__init__(*args, **kwargs)
+        # Image as last saved, to tell when it needs processing
+        self._original_image_name = self._get_image_name()
+
+    def _get_image_name(self):
+        image = self.__dict__.get('image')
+        return getattr(image, 'name', image) or ''
+
+    def _name_upload(self):
+        """
+        Name a new upload after its content and verified format, reusing the original
+        already stored for the same content
+        :raise ValidationError: if it isn't an image in an accepted format
+        """
+        name = get_upload_name(self.image.file)
+        stored_name = self.image.field.generate_filename(self, name)
+        if self.image.storage.exists(stored_name):
+            self.image = stored_name
+        else:
+            # upload_to is prepended when the file is saved
+            self.image.name = name
 
     def save(self, *args, **kwargs):
-        existing_avatar = ForumAvatar.objects.filter(user=self.user).first()
-        if existing_avatar:
-            self.id = existing_avatar.id
+        self.gravatar_hash = gravatar_hash(self.user.email)
         if not self.image:
             self.use_gravatar = True
+        if self.image and not self.image._committed:
+            self._name_upload()
+        # Thumbnails are made in a task, gravatar is shown until then
+        image_changed = self._get_image_name() != self._original_image_name or (
+            self.image and not self.image._committed
+        )
+        replaced = []
+        if image_changed:
+            replaced = list(json.loads(self.thumbnails).values()) if self.thumbnails else []
+            self.thumbnails = ''
+        if self.pk is None:
+            try:
+                with transaction.atomic():
+                    super(ForumAvatar, self).save(*args, **kwargs)
+            except IntegrityError:
+                # The user has an avatar already, replace it
+                existing = ForumAvatar.objects.filter(user_id=self.user_id).values_list('pk', 'thumbnails').first()
+                if existing is None:
+                    raise
+                self.pk = existing[0]
+                if image_changed and existing[1]:
+                    replaced = list(json.loads(existing[1]).values())
+                kwargs.pop('force_insert', None)
+                super(ForumAvatar, self).save(*args, **kwargs)
         else:
-            i = Image.open(self.image)
-            i.thumbnail((120, 120), Image.ANTIALIAS)
-            i_io = BytesIO()
-            i.save(i_io, format='PNG')
-            self.image = InMemoryUploadedFile(
-                i_io, None, '%s.png' % self.user_id, 'image/png', None, None
-            )
-        print(self.image)
-        super(ForumAvatar, self).save(*args, **kwargs)
+            super(ForumAvatar, self).save(*args, **kwargs)
+        self._original_image_name = self._get_image_name()
+        if image_changed and (self.image or replaced):
+            _on_commit(partial(process_avatar.delay, self.pk, self._get_image_name(), replaced))
 
     def __str__(self):
         return "Avatar for user: %s" % self.user.username
+
+
+@receiver(post_save, sender=ForumAvatar)
+@receiver(post_delete, sender=ForumAvatar)
+def _avatar_changed(sender, instance, **kwargs):
+    invalidate_avatar(instance.user_id)
+    bump_version('user', instance.user_id)
+    bump_page_versions(site=True)
+
+
+def _shown_user_fields(user):
+    # Deferred fields are missing from __dict__, taken as changed when saved
+    return user.__dict__.get('username'), user.__dict__.get('email')
+
+
+@receiver(post_init, sender=USER_MODEL)
+def _user_loaded(sender, instance, **kwargs):
+    instance._niji_shown_fields = _shown_user_fields(instance)
+
+
+@receiver(post_save, sender=USER_MODEL)
+def _user_saved(sender, instance, created, update_fields=None, **kwargs):
+    # Pages show the username and the avatar, which depends on the email. A new user is on no
+    # page yet, and e.g. last_login updates on every login change neither.
+    if update_fields is not None and not set(update_fields) & set(['username', 'email']):
+        return
+    shown = _shown_user_fields(instance)
+    original, instance._niji_shown_fields = getattr(instance, '_niji_shown_fields', (None, None)), shown
+    if created or (None not in original and original == shown):
+        return
+    ForumAvatar.objects.filter(user=instance).update(gravatar_hash=gravatar_hash(instance.email))
+    invalidate_avatar(instance.pk)
+    bump_version('user', instance.pk)
+    bump_page_versions(site=True)
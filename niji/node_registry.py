@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import get_language
+import uuid
+
+CachedNode = namedtuple('CachedNode', ['pk', 'title', 'description', 'visible_topic_count'])
+CachedNodeGroup = namedtuple('CachedNodeGroup', ['pk', 'title', 'nodes'])
+# version tells registries apart, fragments rendered from one are keyed by it
+NodeRegistry = namedtuple('NodeRegistry', ['version', 'nodes', 'groups', 'ungrouped'])
+
+_REGISTRY_KEY = 'niji:nodes'
+
+
+def _get_cache():
+    return caches[getattr(settings, 'NIJI_NODE_CACHE_ALIAS', 'default')]
+
+
+def _get_timeout():
+    return getattr(settings, 'NIJI_NODE_CACHE_TIMEOUT', 300)
+
+
+def build_node_registry():
+    """
+    :return: NodeRegistry of all nodes and node groups, from two queries
+    """
+    from niji.models import Node, NodeGroup
+    nodes = [
+        CachedNode(*row) for row in
+        Node.objects.order_by('pk').values_list('pk', 'title', 'description', 'visible_topic_count')
+    ]
+    by_pk = dict((node.pk, node) for node in nodes)
+    groups = {}
+    for pk, title, node_id in NodeGroup.objects.order_by('pk', 'node__pk').values_list('pk', 'title', 'node__pk'):
+        group = groups.setdefault(pk, CachedNodeGroup(pk, title, []))
+        if node_id in by_pk:
+            group.nodes.append(by_pk[node_id])
+    grouped = set(node.pk for group in groups.values() for node in group.nodes)
+    return NodeRegistry(
+        uuid.uuid4().hex, nodes, [groups[pk] for pk in sorted(groups)],
+        [node for node in nodes if node.pk not in grouped]
+    )
+
+
+def get_node_registry():
+    """
+    :return: the cached NodeRegistry, kept for NIJI_NODE_CACHE_TIMEOUT seconds and dropped
+             when a node or node group changes. Topic counts may lag for that long.
+    """
+    timeout = _get_timeout()
+    if not timeout:
+        return build_node_registry()
+    cache = _get_cache()
+    registry = cache.get(_REGISTRY_KEY)
+    if registry is None:
+        registry = build_node_registry()
+        cache.set(_REGISTRY_KEY, registry, timeout)
+    return registry
+
+
+def get_nodes():
+    """
+    :return: list of CachedNode
+    """
+    return get_node_registry().nodes
+
+
+def get_node_choices():
+    """
+    :return: list of (pk, title) for choice fields
+    """
+    return [(node.pk, node.title) for node in get_nodes()]
+
+
+def invalidate_node_registry():
+    _get_cache().delete(_REGISTRY_KEY)
+
+
+def render_node_fragment(name, render):
+    """
+    Render a fragment showing the node registry, cached until the registry changes
+    :param name: name of the fragment
+    :param render: callable rendering the fragment from a NodeRegistry
+    """
+    registry = get_node_registry()
+    timeout = _get_timeout()
+    if not timeout:
+        return render(registry)
+    cache = _get_cache()
+    key = 'niji:nodes:%s:%s:%s' % (name, registry.version, get_language())
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = render(registry)
+        cache.set(key, fragment, timeout)
+    return fragment
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.translation import get_language
+import six
+import time
+import xxhash
+
+# Version every cached page depends on, bumped by changes shown on all pages (node list, avatars)
+SITE = ('site', 0)
+# Version of the index, bumped together with any node's
+ALL_NODES = ('node', 'all')
+
+_SITE_MODIFIED_KEY = 'niji:site-modified'
+
+
+def _get_cache():
+    return caches[getattr(settings, 'NIJI_PAGE_CACHE_ALIAS', 'default')]
+
+
+def _get_timeout():
+    return getattr(settings, 'NIJI_PAGE_CACHE_TIMEOUT', 0)
+
+
+def page_cache_enabled():
+    return bool(_get_timeout())
+
+
+def _version_key(kind, pk):
+    return 'niji:page-version:%s:%s' % (kind, pk)
+
+
+def bump_page_versions(topics=(), nodes=(), site=False):
+    """
+    Make the cached pages showing the given objects unreachable
+    :param topics: ids of changed topics
+    :param nodes: ids of nodes whose topic lists changed
+    :param site: whether something shown on every page changed
+    """
+    if site:
+        # Recorded even without the page cache, for the validators of every page
+        _get_cache().set(_SITE_MODIFIED_KEY, timezone.now(), None)
+    if not page_cache_enabled():
+        return
+    versions = set(('topic', pk) for pk in topics if pk is not None)
+    versions.update(('node', pk) for pk in nodes if pk is not None)
+    if versions:
+        versions.add(ALL_NODES)
+    if site:
+        versions.add(SITE)
+    cache = _get_cache()
+    for kind, pk in versions:
+        key = _version_key(kind, pk)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Counters start from the clock, one evicted and created again can't repeat an old value
+            if not cache.add(key, int(time.time() * 1000), None):
+                cache.incr(key)
+
+
+def get_site_modified():
+    """
+    :return: datetime something shown on every page last changed at, now if that was forgotten
+    """
+    cache = _get_cache()
+    modified = cache.get(_SITE_MODIFIED_KEY)
+    if modified is None:
+        modified = timezone.now()
+        if not cache.add(_SITE_MODIFIED_KEY, modified, None):
+            modified = cache.get(_SITE_MODIFIED_KEY, modified)
+    return modified
+
+
+def _get_versions(versions):
+    cache = _get_cache()
+    keys = [_version_key(kind, pk) for kind, pk in versions]
+    found = cache.get_many(keys)
+    missing = dict((key, int(time.time() * 1000)) for key in keys if key not in found)
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return [found[key] for key in keys]
+
+
+class AnonymousPageCacheMixin(object):
+    """
+    View mixin serving GET requests of anonymous users from a cache for NIJI_PAGE_CACHE_TIMEOUT seconds.
+
+    Pages are keyed by URL, ordering and language, and by the versions of what they show, which model
+    changes bump, so no key has to be deleted. Responses that set cookies or used a CSRF token,
+    which is bound to the visitor's cookie, are not cached.
+    """
+
+    def get_page_cache_versions(self):
+        """
+        :return: list of (kind, pk) versions the page depends on
+        """
+        return [SITE]
+
+    def get_page_cache_key(self):
+        parts = [self.request.get_full_path(), self.get_ordering(), get_language()]
+        parts.extend(_get_versions(self.get_page_cache_versions()))
+        digest = xxhash.xxh64('|'.join(six.text_type(part) for part in parts).encode('utf-8')).hexdigest()
+        return 'niji:page:%s' % digest
+
+    def served_from_cache(self):
+        """
+        Called when a request is answered from the cache, for the side effects of building the page
+        """
+
+    def get(self, request, *args, **kwargs):
+        if not page_cache_enabled() or request.user.is_authenticated():
+            return super(AnonymousPageCacheMixin, self).get(request, *args, **kwargs)
+
+        cache = _get_cache()
+        key = self.get_page_cache_key()
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            self.served_from_cache()
+            return HttpResponse(content, content_type=content_type)
+
+        response = super(AnonymousPageCacheMixin, self).get(request, *args, **kwargs)
+
+        def store(response):
+            if response.status_code == 200 and not response.cookies and not request.META.get('CSRF_COOKIE_USED'):
+                cache.set(key, (response.content, response['Content-Type']), _get_timeout())
+
+        if hasattr(response, 'add_post_render_callback'):
+            response.add_post_render_callback(store)
+        else:
+            store(response)
+        return response
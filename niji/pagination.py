@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator, Page, InvalidPage, EmptyPage, PageNotAnInteger
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+from django.utils.translation import ugettext as _
+from functools import partial
+import base64
+import json
+import xxhash
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+# Query parameters carrying cursors, numbered page links drop them
+CURSOR_PARAMS = ('after', 'before')
+
+
+def get_max_page():
+    """
+    :return: deepest page number linked to, pages after it are linked by cursor
+    """
+    return getattr(settings, 'NIJI_PAGINATION_MAX_PAGE', 50)
+
+
+def exact_count(queryset):
+    """
+    Count source running COUNT(*) on every request
+    """
+    return queryset.order_by().count()
+
+
+def cached_count(queryset):
+    """
+    Count source keeping counts for NIJI_PAGINATION_COUNT_TIMEOUT seconds, keyed by the query
+    """
+    queryset = queryset.order_by()
+    cache = caches[getattr(settings, 'NIJI_PAGINATION_COUNT_CACHE_ALIAS', 'default')]
+    key = 'niji:count:%s' % xxhash.xxh64(str(queryset.query).encode('utf-8')).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, getattr(settings, 'NIJI_PAGINATION_COUNT_TIMEOUT', 60))
+    return count
+
+
+def estimated_count(queryset):
+    """
+    Count source using the planner's row estimate on PostgreSQL once it reaches
+    NIJI_PAGINATION_ESTIMATE_THRESHOLD rows, smaller or other sets are counted by cached_count
+    """
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate >= getattr(settings, 'NIJI_PAGINATION_ESTIMATE_THRESHOLD', 100000):
+            return estimate
+    return cached_count(queryset)
+
+
+def get_count_source():
+    """
+    :return: the configured count source, a callable taking a queryset and returning its number of rows
+    """
+    return import_string(getattr(settings, 'NIJI_PAGINATION_COUNT_SOURCE', 'niji.pagination.exact_count'))
+
+
+def with_tie_break(ordering):
+    """
+    :param ordering: list of order_by arguments
+    :return: ordering ending with the primary key in the direction of its last field, the
+             tie-break cursors assume, so numbered pages and cursor pages meet without gaps
+    """
+    ordering = list(ordering)
+    return ordering + ['-pk' if ordering and ordering[-1].startswith('-') else 'pk']
+
+
+def get_ordering_keys(queryset):
+    """
+    :return: list of (field name, descending) the queryset is ordered by, ending with the primary key
+    """
+    model = queryset.model
+    keys = []
+    for name in list(queryset.query.order_by) or list(model._meta.ordering):
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == model._meta.pk.name:
+            name = 'pk'
+        keys.append((name, descending))
+        if name == 'pk':
+            return keys
+    # Rows with the same values are told apart by primary key
+    keys.append(('pk', keys[-1][1] if keys else False))
+    return keys
+
+
+def encode_cursor(obj, keys):
+    """
+    :return: opaque cursor pointing at obj in an ordering
+    """
+    values = []
+    for name, descending in keys:
+        value = getattr(obj, name)
+        values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+    cursor = base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8'))
+    return cursor.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, model, keys):
+    """
+    :return: list of values of the ordering keys a cursor points at
+    :raise InvalidPage: if the cursor is malformed
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor + '=' * (-len(cursor) % 4))).decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError(cursor)
+        return [
+            (model._meta.pk if name == 'pk' else model._meta.get_field(name)).to_python(value)
+            for (name, descending), value in zip(keys, values)
+        ]
+    except (TypeError, ValueError, UnicodeError, ValidationError):
+        raise InvalidPage(_('Invalid cursor'))
+
+
+def keyset_filter(keys, values, backwards=False):
+    """
+    :return: Q matching the rows after the given key values in the ordering, or before them if backwards
+    """
+    condition = None
+    for i, (name, descending) in enumerate(keys):
+        lookup = 'lt' if descending != backwards else 'gt'
+        term = Q(**{'%s__%s' % (name, lookup): values[i]})
+        for j in range(i):
+            term &= Q(**{keys[j][0]: values[j]})
+        condition = term if condition is None else condition | term
+    # Bound the leading key too, so an index on it can serve the range
+    name, descending = keys[0]
+    return Q(**{'%s__%s' % (name, 'lte' if descending != backwards else 'gte'): values[0]}) & condition
+
+
+class KeysetPage(Sequence):
+    """
+    A page of rows right after or before a cursor, without a number
+    """
+    number = None
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<Page at cursor>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def keyset_page(queryset, per_page, paginator, after=None, before=None):
+    """
+    :return: KeysetPage with the per_page rows after the ``after`` cursor, or before the ``before`` one
+    :raise InvalidPage: if the cursor is malformed or no row is left
+    """
+    keys = get_ordering_keys(queryset)
+    backwards = not after
+    values = decode_cursor(after or before, queryset.model, keys)
+    ordering = [('-' if descending != backwards else '') + name for name, descending in keys]
+    rows = list(queryset.filter(keyset_filter(keys, values, backwards)).order_by(*ordering)[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not rows:
+        raise EmptyPage(_('That page contains no results'))
+    if backwards:
+        rows.reverse()
+        return KeysetPage(
+            rows, paginator, encode_cursor(rows[-1], keys), encode_cursor(rows[0], keys) if more else None
+        )
+    return KeysetPage(
+        rows, paginator, encode_cursor(rows[-1], keys) if more else None, encode_cursor(rows[0], keys)
+    )
+
+
+class CountSourcePaginator(Paginator):
+    """
+    Paginator taking its count from a callable instead of counting the object list
+    """
+
+    def __init__(self, object_list, per_page, count_source=None, **kwargs):
+        super(CountSourcePaginator, self).__init__(object_list, per_page, **kwargs)
+        self.count_source = count_source
+
+    @cached_property
+    def count(self):
+        if self.count_source is None:
+            return Paginator.count.func(self)
+        return self.count_source()
+
+
+class NoCountPage(Page):
+
+    def __init__(self, object_list, number, paginator, more):
+        super(NoCountPage, self).__init__(object_list, number, paginator)
+        self.more = more
+
+    def has_next(self):
+        return self.more
+
+
+class NoCountPaginator(CountSourcePaginator):
+    """
+    Never counts the rows: ``count`` and ``num_pages`` are None, and each page fetches
+    one extra row to know whether there is a next one.
+    """
+    count = None
+    num_pages = None
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not object_list and (number > 1 or not self.allow_empty_first_page):
+            raise EmptyPage(_('That page contains no results'))
+        return NoCountPage(object_list[:self.per_page], number, self, len(object_list) > self.per_page)
+
+
+class KeysetPaginationMixin(object):
+    """
+    ListView mixin serving numbered pages up to NIJI_PAGINATION_MAX_PAGE and linking deeper
+    pages by cursors on the queryset ordering, which cost the same at any depth.
+    """
+    paginator_class = CountSourcePaginator
+
+    def get_pagination_count(self, queryset):
+        """
+        :return: number of rows in queryset, views with a denormalized count return it instead
+        """
+        return get_count_source()(queryset)
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        paginator_class = self.paginator_class
+        if not getattr(settings, 'NIJI_PAGINATION_COUNT', True):
+            paginator_class = NoCountPaginator
+        kwargs.setdefault('count_source', partial(self.get_pagination_count, queryset))
+        return paginator_class(
+            queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page, **kwargs
+        )
+
+    def paginate_queryset(self, queryset, page_size):
+        page_number = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        if str(page_number).isdigit() and int(page_number) > get_max_page():
+            # Deeper pages are reached by cursor, never by OFFSET
+            raise Http404(_('Invalid page: %(message)s') % {'message': _('That page is only reached by cursor')})
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+        if after or before:
+            paginator = self.get_paginator(queryset, page_size, allow_empty_first_page=self.get_allow_empty())
+            try:
+                page = keyset_page(queryset, page_size, paginator, after=after, before=before)
+            except InvalidPage as e:
+                raise Http404(_('Invalid page: %(message)s') % {'message': str(e)})
+            return paginator, page, page.object_list, page.has_other_pages()
+
+        paginator, page, object_list, is_paginated = super(KeysetPaginationMixin, self).paginate_queryset(
+            queryset, page_size
+        )
+        if page.number > get_max_page():
+            # e.g. ?page=last, checked before the rows are fetched
+            raise Http404(_('Invalid page: %(message)s') % {'message': _('That page is only reached by cursor')})
+        page.object_list = object_list = list(object_list)
+        page.next_cursor = page.previous_cursor = None
+        if object_list and page.number >= get_max_page() and page.has_next():
+            page.next_cursor = encode_cursor(object_list[-1], get_ordering_keys(queryset))
+        return paginator, page, object_list, is_paginated
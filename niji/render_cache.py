@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+import threading
+
+
+class RenderCache(object):
+    """
+    Content-addressed cache of rendered markdown.
+
+    Keys are expected to identify the raw content and the renderer version,
+    values are rendered HTML. Lookups go through an in-process LRU first and
+    then, if ``cache_alias`` is given, through a shared Django cache.
+    """
+
+    def __init__(self, size=512, cache_alias=None, timeout=None):
+        self.size = size
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.local_hits = 0
+        self.shared_hits = 0
+
+    @property
+    def shared(self):
+        if self.cache_alias is None:
+            return None
+        return caches[self.cache_alias]
+
+    def _key(self, key):
+        return 'niji:render:%s' % key
+
+    def _get_local(self, key):
+        with self._lock:
+            try:
+                value = self._lru.pop(key)
+            except KeyError:
+                return None
+            self._lru[key] = value
+            return value
+
+    def _set_local(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._lru.pop(key, None)
+            self._lru[key] = value
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+
+    def get(self, key):
+        value = self._get_local(key)
+        if value is not None:
+            self.hits += 1
+            self.local_hits += 1
+            return value
+        if self.shared is not None:
+            value = self.shared.get(self._key(key))
+            if value is not None:
+                self._set_local(key, value)
+                self.hits += 1
+                self.shared_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.shared is not None:
+            self.shared.set(self._key(key), value, self.timeout)
+
+    def get_or_render(self, key, render):
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+        self.hits = self.misses = self.local_hits = self.shared_hits = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'size': len(self._lru),
+        }
+
+
+_render_cache = None
+
+
+def get_render_cache():
+    global _render_cache
+    if _render_cache is None:
+        backend = import_string(getattr(settings, 'NIJI_RENDER_CACHE_BACKEND', 'niji.render_cache.RenderCache'))
+        _render_cache = backend(
+            size=getattr(settings, 'NIJI_RENDER_CACHE_SIZE', 512),
+            cache_alias=getattr(settings, 'NIJI_RENDER_CACHE_ALIAS', None),
+            timeout=getattr(settings, 'NIJI_RENDER_CACHE_TIMEOUT', None),
+        )
+    return _render_cache
+
+
+@receiver(setting_changed)
+def _reset_render_cache(sender, setting, **kwargs):
+    global _render_cache
+    if setting.startswith('NIJI_RENDER_CACHE'):
+        _render_cache = None
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.translation import get_language
+import calendar
+import six
+import uuid
+import xxhash
+
+# (age in seconds, bucket in seconds) pairs: naturaltime shows minutes for the first hour,
+# then hours for the first week ("2 days, 5 hours"), then days or longer ("1 week, 3 days").
+# Rows younger than a minute aren't cached.
+_TIME_BUCKETS = [(60, None), (3600, 60), (7 * 86400, 3600)]
+_OLD_BUCKET = 86400
+
+
+def _get_cache():
+    return caches[getattr(settings, 'NIJI_ROW_CACHE_ALIAS', 'default')]
+
+
+def _get_timeout():
+    return getattr(settings, 'NIJI_ROW_CACHE_TIMEOUT', 600)
+
+
+def _version_key(kind, pk):
+    return 'niji:row-version:%s:%s' % (kind, pk)
+
+
+def bump_version(kind, pk):
+    """
+    Make the cached rows depending on an object unreachable
+    :param kind: 'topic' or 'user'
+    :param pk: pk of the topic or user
+    """
+    if _get_timeout():
+        # Random rather than counted, an evicted version can't come back
+        _get_cache().set(_version_key(kind, pk), uuid.uuid4().hex, None)
+
+
+def _get_versions(keys):
+    cache = _get_cache()
+    versions = cache.get_many(keys)
+    missing = dict((key, uuid.uuid4().hex) for key in keys if key not in versions)
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return versions
+
+
+def time_bucket(value, now):
+    """
+    :return: number of the period now falls in, within which value shows the same
+             naturaltime, None if that changes too often to cache
+    """
+    age = (now - value).total_seconds()
+    size = _OLD_BUCKET
+    for max_age, bucket in _TIME_BUCKETS:
+        if age < max_age:
+            size = bucket
+            break
+    if size is None:
+        return None
+    return '%s/%s' % (size, calendar.timegm(now.utctimetuple()) // size)
+
+
+def render_topic_rows(topics, render_row):
+    """
+    Render topic list rows, reusing rows cached for NIJI_ROW_CACHE_TIMEOUT seconds. A cached row is
+    found again while the topic and its author are unchanged and its relative times read the same.
+    :param topics: topics with user and node loaded
+    :param render_row: callable rendering the row of a topic
+    :return: list of rendered rows
+    """
+    topics = list(topics)
+    timeout = _get_timeout()
+    if not timeout or not topics:
+        return [render_row(topic) for topic in topics]
+
+    cache = _get_cache()
+    now = timezone.now()
+    language = get_language()
+    versions = _get_versions(
+        [_version_key('topic', topic.pk) for topic in topics] +
+        [_version_key('user', topic.user_id) for topic in topics]
+    )
+    keys = []
+    for topic in topics:
+        # last_replied is the youngest timestamp shown
+        bucket = time_bucket(topic.last_replied, now)
+        if bucket is None:
+            keys.append(None)
+            continue
+        parts = [
+            versions[_version_key('topic', topic.pk)],
+            versions[_version_key('user', topic.user_id)],
+            topic.last_replied.isoformat(), topic.reply_count, topic.node.title, bucket, language,
+        ]
+        digest = xxhash.xxh64('|'.join(six.text_type(part) for part in parts).encode('utf-8')).hexdigest()
+        keys.append('niji:row:%s:%s' % (topic.pk, digest))
+
+    cached = cache.get_many([key for key in keys if key])
+    rows = []
+    to_cache = {}
+    for topic, key in zip(topics, keys):
+        row = cached.get(key) if key else None
+        if row is None:
+            row = render_row(topic)
+            if key:
+                to_cache[key] = row
+        rows.append(row)
+    if to_cache:
+        cache.set_many(to_cache, timeout)
+    return rows
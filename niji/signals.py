@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+# Sent when rendering hits a limit, guard is one of 'length', 'time' or 'mentions'
+render_guard_tripped = Signal(providing_args=['guard', 'content_length'])
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from celery import shared_task
 from celery.utils.log import get_task_logger
 from django.contrib.auth import get_user_model
+import six
 
 
 logger = get_task_logger(__name__)
@@ -10,20 +11,135 @@ logger = get_task_logger(__name__)
 
 @shared_task
 def notify(sender, to, topic=None, post=None):
+    """
+    Notify all users mentioned in a topic or post
+    :param sender: pk of the author
+    :param to: list of recipient pks
+    :param topic: pk of the topic mentioning them
+    :param post: pk of the post mentioning them
+    :return: number of notifications created
+    """
     from niji.models import Notification, Topic, Post
     User = get_user_model()
 
-    if not any([topic, post]):
-        logger.warning('No topic or post provided, ignored')
+    if isinstance(to, six.string_types):
+        # Queued by an older version, one task per username
+        sender = User.objects.get(username=sender).pk
+        to = list(User.objects.filter(username=to).values_list('pk', flat=True))
 
-    ntf, created = Notification.objects.get_or_create(
-        topic=Topic.objects.filter(pk=topic).first(),
-        post=Post.objects.filter(pk=post).first(),
-        sender=User.objects.get(username=sender),
-        to=User.objects.get(username=to)
-    )
-    if created:
-        logger.info('Successfully created notification from {0.sender.username} to {0.to.username}'.format(ntf))
+    if post is not None:
+        if not Post.objects.filter(pk=post).exists():
+            logger.warning('Post {} no longer exists, ignored'.format(post))
+            return 0
+        existing = Notification.objects.filter(post_id=post)
+    elif topic is not None:
+        if not Topic.objects.filter(pk=topic).exists():
+            logger.warning('Topic {} no longer exists, ignored'.format(topic))
+            return 0
+        existing = Notification.objects.filter(topic_id=topic, post__isnull=True)
     else:
-        logger.info('Ignored duplicated notification from {0.sender.username} to {0.to.username}'.format(ntf))
+        logger.warning('No topic or post provided, ignored')
+        return 0
+
+    recipients = set(User.objects.filter(pk__in=to).exclude(pk=sender).values_list('pk', flat=True))
+    recipients.difference_update(existing.filter(to_id__in=recipients).values_list('to_id', flat=True))
+    notifications = [
+        Notification(sender_id=sender, to_id=pk, topic_id=None if post is not None else topic, post_id=post)
+        for pk in sorted(recipients)
+    ]
+    created = Notification.objects.bulk_create_unique(notifications)
+    logger.info('Created {} notification(s) from user {}, ignored {} duplicate(s)'.format(
+        created, sender, len(to) - created
+    ))
+    return created
+
+
+@shared_task
+def render(model_name, pk, content_hash, notify_mentions=False):
+    from niji.models import Topic, Post, Appendix
+    model = {'topic': Topic, 'post': Post, 'appendix': Appendix}[model_name]
+
+    queryset = model.objects.filter(pk=pk)
+    if model is not Appendix:
+        queryset = queryset.select_related('user')
+    obj = queryset.first()
+    if obj is None:
+        logger.warning('{} {} no longer exists, ignored'.format(model_name, pk))
+        return False
+    if obj.get_content_hash() != content_hash:
+        # Edited again since, the render task queued by that save takes over
+        logger.info('{} {} changed since queued, ignored'.format(model_name, pk))
+        return False
+
+    content_rendered, mentioned_users = obj.render(content_hash)
+    obj.set_rendered(content_rendered, content_hash)
+    obj.save_rendered()
+    if notify_mentions:
+        obj.notify_mentioned(mentioned_users)
     return True
+
+
+@shared_task
+def flush_view_counts():
+    from niji.view_counts import get_view_count_buffer
+
+    view_count_buffer = get_view_count_buffer()
+    if view_count_buffer is None:
+        return 0
+    if not view_count_buffer.shared:
+        logger.warning('Memory view count buffers are flushed by the web processes holding them, ignored')
+        return 0
+    updated = view_count_buffer.flush()
+    logger.info('Flushed buffered views of {} topic(s)'.format(updated))
+    return updated
+
+
+@shared_task
+def purge_notifications():
+    from django.conf import settings
+    from django.utils import timezone
+    from niji.models import Notification
+    from datetime import timedelta
+
+    days = getattr(settings, 'NIJI_NOTIFICATION_RETENTION_DAYS', 90)
+    if days is None:
+        return 0
+    deleted = Notification.objects.purge_read(
+        timezone.now() - timedelta(days=days),
+        getattr(settings, 'NIJI_NOTIFICATION_PURGE_CHUNK_SIZE', 1000),
+        getattr(settings, 'NIJI_NOTIFICATION_PURGE_SLEEP', 0.1),
+    )
+    logger.info('Deleted {} read notification(s) older than {} day(s)'.format(deleted, days))
+    return deleted
+
+
+@shared_task
+def process_avatar(pk, image_name, replaced=()):
+    """
+    Make the thumbnails of an uploaded avatar
+    :param pk: pk of the ForumAvatar
+    :param image_name: name of the stored original, the task is skipped if it was replaced since
+    :param replaced: names of the thumbnails of the image it replaced, deleted unless still used
+    :return: whether thumbnails were made
+    """
+    from niji.models import ForumAvatar
+    from niji.avatars import make_thumbnails, delete_thumbnails, invalidate_avatar
+    from niji.row_cache import bump_version
+    import json
+
+    avatar = ForumAvatar.objects.filter(pk=pk).first()
+    if avatar is None or avatar.image.name != image_name or not image_name:
+        # The replaced thumbnails go all the same
+        if avatar is not None and replaced:
+            delete_thumbnails(avatar.image.storage, replaced)
+        logger.info('Avatar {} changed since queued, ignored'.format(pk))
+        return False
+    thumbnails = make_thumbnails(avatar.image, '%sthumbnails/' % avatar.image.field.upload_to, replaced)
+    updated = ForumAvatar.objects.filter(pk=pk, image=image_name).update(
+        thumbnails=json.dumps(dict((str(size), name) for size, name in thumbnails.items()))
+    )
+    # Saved with an UPDATE, without the signals which drop cached avatars
+    invalidate_avatar(avatar.user_id)
+    bump_version('user', avatar.user_id)
+    logger.info('Made {} thumbnail(s) of avatar {}'.format(len(thumbnails), pk))
+    return bool(updated)
@@ -1,10 +1,13 @@
 from django import template
 from django.utils.html import escape
+from django.utils.safestring import mark_safe
 from django.contrib.auth.models import User
 from six.moves.urllib.parse import urlencode, urlparse, parse_qs
 from django.core.urlresolvers import reverse
-from niji.models import ForumAvatar
-import hashlib
+from niji import avatars
+from niji.pagination import CURSOR_PARAMS, get_max_page
+from niji.row_cache import render_topic_rows
+from niji.node_registry import render_node_fragment
 
 register = template.Library()
 
@@ -15,32 +18,16 @@ def gravatar_url(user, size=48):
         email = user.email
     else:
         email = user
+    return escape(avatars.gravatar_url(avatars.gravatar_hash(email), size))
 
-    default = ""
 
-    avatar_url = "http://www.gravatar.com/avatar/" + hashlib.md5(
-        email.lower().encode('utf-8')
-    ).hexdigest() + "?"
-    avatar_url += urlencode({'d': default, 's': str(size)})
+@register.simple_tag(takes_context=True)
+def avatar_url(context, user, size=48, no_gravatar=False):
+    resolver = avatars.get_avatar_resolver(context.get('request'))
+    return escape(resolver.url(user, size, no_gravatar))
 
-    return escape(avatar_url)
 
-
-@register.simple_tag
-def avatar_url(user, size=48, no_gravatar=False):
-    try:
-        avatar = user.forum_avatar
-    except ForumAvatar.DoesNotExist:
-        return gravatar_url(user, size)
-    else:
-        if avatar.use_gravatar and not no_gravatar or not avatar.image:
-            return gravatar_url(user, size)
-        else:
-            return avatar.image.url
-
-
-@register.simple_tag
-def change_url(request, kwargs=None, query=None):
+def _build_url(request, kwargs=None, query=None, drop=()):
     kwargs = kwargs or {}
     query = query or {}
     rm = request.resolver_match
@@ -49,6 +36,8 @@ def change_url(request, kwargs=None, query=None):
     if _kwargs.get("page") == 1:
         _kwargs.pop('page', None)
     qs = parse_qs(urlparse(request.get_full_path()).query)
+    for key in drop:
+        qs.pop(key, None)
     qs.update(query)
     path = reverse(
         '%s:%s' % (rm.namespace, rm.url_name),
@@ -61,14 +50,44 @@ def change_url(request, kwargs=None, query=None):
         return path
 
 
+@register.simple_tag
+def change_url(request, kwargs=None, query=None):
+    return _build_url(request, kwargs, query)
+
+
 @register.simple_tag
 def change_page(request, page=1):
-    return change_url(request, {"page": page})
+    return _build_url(request, {"page": page}, None, CURSOR_PARAMS)
+
+
+@register.simple_tag
+def change_cursor(request, after=None, before=None):
+    query = {'after': after} if after else {'before': before}
+    return _build_url(request, {"page": 1}, query, CURSOR_PARAMS)
 
 
 @register.simple_tag
 def change_topic_ordering(request, ordering):
-    return change_url(request, None, {"order": ordering})
+    # Cursors only make sense in the ordering they were taken from
+    return _build_url(request, None, {"order": ordering}, CURSOR_PARAMS)
+
+
+@register.simple_tag(takes_context=True)
+def topic_rows(context, topics):
+    template = context.template.engine.get_template('niji/includes/topic_row.html')
+    # request keeps the avatars resolved once per request
+    rows = render_topic_rows(topics, lambda topic: template.render(context.new({
+        'topic': topic, 'request': context.get('request'),
+    })))
+    return mark_safe(''.join(rows))
+
+
+@register.simple_tag(takes_context=True)
+def nodes_widget(context):
+    template = context.template.engine.get_template('niji/widgets/nodes.html')
+    return mark_safe(render_node_fragment('widget', lambda registry: template.render(context.new({
+        'nodes': registry.nodes, 'node_groups': registry.groups, 'ungrouped_nodes': registry.ungrouped,
+    }))))
 
 
 @register.inclusion_tag('niji/includes/pagination.html', takes_context=True)
@@ -78,12 +97,29 @@ def get_pagination(context, first_last_amount=2, before_after_amount=4):
     is_paginated = context['is_paginated']
     page_numbers = []
 
+    if page_obj.number is None:
+        # Reached by cursor, only the first page is linked by number
+        return {
+            'paginator': paginator,
+            'page_obj': page_obj,
+            'page_numbers': [1, None],
+            'is_paginated': is_paginated,
+            'request': context['request'],
+        }
+
+    # Deeper pages are only linked by cursor, see KeysetPaginationMixin
+    num_pages = paginator.num_pages
+    if num_pages is None:
+        # Not counted, only the next page is known to exist
+        num_pages = page_obj.number + 1 if page_obj.has_next() else page_obj.number
+    num_pages = max(min(num_pages, get_max_page()), page_obj.number)
+
     # Pages before current page
     if page_obj.number > first_last_amount + before_after_amount:
         for i in range(1, first_last_amount + 1):
             page_numbers.append(i)
 
-        if first_last_amount + before_after_amount + 1 != paginator.num_pages:
+        if first_last_amount + before_after_amount + 1 != num_pages:
             page_numbers.append(None)
 
         for i in range(page_obj.number - before_after_amount, page_obj.number):
@@ -94,17 +130,17 @@ def get_pagination(context, first_last_amount=2, before_after_amount=4):
             page_numbers.append(i)
 
     # Current page and pages after current page
-    if page_obj.number + first_last_amount + before_after_amount < paginator.num_pages:
+    if page_obj.number + first_last_amount + before_after_amount < num_pages:
         for i in range(page_obj.number, page_obj.number + before_after_amount + 1):
             page_numbers.append(i)
 
         page_numbers.append(None)
 
-        for i in range(paginator.num_pages - first_last_amount + 1, paginator.num_pages + 1):
+        for i in range(num_pages - first_last_amount + 1, num_pages + 1):
             page_numbers.append(i)
 
     else:
-        for i in range(page_obj.number, paginator.num_pages + 1):
+        for i in range(page_obj.number, num_pages + 1):
             page_numbers.append(i)
 
     return {
@@ -1,21 +1,56 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase, LiveServerTestCase
+from django.test import TestCase, LiveServerTestCase, RequestFactory
+from unittest import skipUnless
 from django.utils.translation import ugettext as _
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, resolve
 from rest_framework.reverse import reverse as api_reverse
-from django.contrib.auth.models import User
-from .models import Topic, Node, Post, Notification, Appendix
-from django.test.utils import override_settings
+from django.contrib.auth.models import User, AnonymousUser
+from django.middleware.csrf import get_token
+from .models import (
+    Topic, Node, NodeGroup, Post, Notification, Appendix, ForumAvatar, RENDERER_VERSION, TimedOutRender,
+    render_content, render_markdown, find_mentions, link_mentions, recount_nodes
+)
+from .admin import NodeAdmin
+from .forms import ForumAvatarForm
+from django.core.exceptions import ValidationError
+from django.contrib import admin
+from .signals import render_guard_tripped
+from . import misc, conditional
+from . import models as niji_models
+from .render_cache import RenderCache, get_render_cache
+from .mentions import resolve_mentions
+from .unread import get_unread_count
+from .row_cache import time_bucket
+from .avatars import AvatarResolver
+from .pagination import get_ordering_keys, keyset_filter
+from .views import Index, NodeView, TopicView, UserTopics
+from .tasks import render, notify, purge_notifications, process_avatar, flush_view_counts
+from .view_counts import get_view_count_buffer
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
+from django.core.management import call_command
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+from six import StringIO
+from io import BytesIO
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+import hashlib
+import threading
 import random
 import requests
 import json
 import time
 import os
+import re
+import tempfile
+import xxhash
 
 if os.environ.get('TEST_USE_FIREFOX'):
     from selenium.webdriver.firefox.webdriver import WebDriver
@@ -494,6 +529,30 @@ class TopicModelTest(TestCase):
         self.t1.save()
         self.assertIn('<strong>first</strong>', self.t1.content_rendered)
 
+    def test_lazy_content_hash(self):
+        t1 = Topic.objects.get(pk=self.t1.pk)
+        self.assertIsNone(t1._content_hash)
+        self.assertFalse(t1.content_changed())
+        t1.content_raw = 'This is test topic __1__'
+        self.assertFalse(t1.content_changed())
+        self.assertIsNone(t1._content_hash)
+        t1.content_raw = 'This is the __first__ topic'
+        self.assertTrue(t1.content_changed())
+
+    def test_deferred_content(self):
+        with self.assertNumQueries(1):
+            topics = list(Topic.objects.only('title'))
+            self.assertTrue(all(t.raw_content_hash is None for t in topics))
+        t1 = Topic.objects.defer('content_raw').get(pk=self.t1.pk)
+        t1.title = 'Renamed'
+        # The topic and its node's last_modified
+        with self.assertNumQueries(2):
+            t1.save()
+        t1 = Topic.objects.defer('content_raw').get(pk=self.t1.pk)
+        t1.content_raw = 'This is the __first__ topic'
+        t1.save()
+        self.assertIn('<strong>first</strong>', Topic.objects.get(pk=self.t1.pk).content_rendered)
+
     def test_last_replied(self):
         p = Post()
         p.topic = self.t1
@@ -563,6 +622,23 @@ class TopicModelTest(TestCase):
         )
         self.assertEqual(self.u1.received_notifications.count(), 0)
 
+    def test_multiple_mentions(self):
+        u3 = User.objects.create_user(
+            username='test3', email='3@q.com', password='333'
+        )
+        t = Topic.objects.create(
+            title='topic mention test',
+            user=self.u1,
+            content_raw='@test2 and @test3 and @test2 again, but not @test22 or @nobody',
+            node=self.n1,
+        )
+        link2 = '<a href="%s">test2</a>' % reverse("niji:user_info", kwargs={"pk": self.u2.pk})
+        link3 = '<a href="%s">test3</a>' % reverse("niji:user_info", kwargs={"pk": u3.pk})
+        self.assertEqual(t.content_rendered.count(link2), 2)
+        self.assertEqual(t.content_rendered.count(link3), 1)
+        self.assertIn('@test22', t.content_rendered)
+        self.assertIn('@nobody', t.content_rendered)
+
 
 class PostModelTest(TestCase):
 
@@ -661,6 +737,1322 @@ class AppendixModelTest(TestCase):
         self.assertIn('<strong>first</strong>', self.a1.content_rendered)
 
 
+class RenderCacheTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        get_render_cache().clear()
+
+    def test_duplicate_content(self):
+        t1 = Topic.objects.create(
+            title='Test Topic 1',
+            user=self.u1,
+            content_raw='duplicated __content__',
+            node=self.n1,
+        )
+        self.assertEqual(get_render_cache().stats()['misses'], 1)
+        t2 = Topic.objects.create(
+            title='Test Topic 2',
+            user=self.u1,
+            content_raw='duplicated __content__',
+            node=self.n1,
+        )
+        Appendix.objects.create(topic=t1, content_raw='duplicated __content__')
+        self.assertEqual(get_render_cache().stats()['hits'], 2)
+        self.assertEqual(t1.content_rendered, t2.content_rendered)
+
+    def test_lru_eviction(self):
+        cache = RenderCache(size=2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_shared_tier(self):
+        cache = RenderCache(size=0, cache_alias='default')
+        self.assertEqual(cache.get_or_render('shared', lambda: 'S'), 'S')
+        self.assertEqual(RenderCache(cache_alias='default').get('shared'), 'S')
+        self.assertEqual(cache.get('shared'), 'S')
+        self.assertEqual(cache.stats()['shared_hits'], 1)
+
+
+class RenderGuardTest(TestCase):
+
+    def setUp(self):
+        self.tripped = []
+        render_guard_tripped.connect(self.on_guard_tripped)
+        get_render_cache().clear()
+
+    def tearDown(self):
+        render_guard_tripped.disconnect(self.on_guard_tripped)
+
+    def on_guard_tripped(self, sender, guard, **kwargs):
+        self.tripped.append(guard)
+
+    @override_settings(NIJI_MAX_MENTIONS=5)
+    def test_mention_cap(self):
+        content = ' '.join('@user%s' % i for i in range(100))
+        self.assertEqual(len(find_mentions(content, 'user0')), 5)
+        self.assertEqual(self.tripped, ['mentions'])
+        self.assertEqual(find_mentions('@' + 'a' * 200, 'sender'), set())
+
+    @override_settings(NIJI_RENDER_MAX_LENGTH=10)
+    def test_length_guard(self):
+        self.assertEqual(render_markdown('__long__ <content>'), '<p>__long__ &lt;content&gt;</p>')
+        self.assertEqual(self.tripped, ['length'])
+
+    @override_settings(NIJI_RENDER_TIME_LIMIT=0.2)
+    def test_time_guard(self):
+        start = time.time()
+        rendered = render_markdown('<' * 20000)
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(rendered.startswith('<p>&lt;&lt;'))
+        self.assertEqual(self.tripped, ['time'])
+
+    def test_time_guard_not_kept(self):
+        content = '<' * 5000
+        with self.settings(NIJI_RENDER_TIME_LIMIT=0.01):
+            appendix = Appendix(content_raw=content)
+            appendix.set_rendered(appendix.render()[0], appendix.get_content_hash())
+        self.assertIsInstance(appendix.content_rendered, TimedOutRender)
+        self.assertTrue(appendix.is_render_stale())
+        # Neither cached nor saved as current, so a later render gets the markdown
+        with self.settings(NIJI_RENDER_TIME_LIMIT=30):
+            appendix.set_rendered(appendix.render()[0], appendix.get_content_hash())
+        self.assertNotIsInstance(appendix.content_rendered, TimedOutRender)
+        self.assertFalse(appendix.is_render_stale())
+        self.assertEqual(self.tripped, ['time'])
+
+    def test_time_limit_outside_main_thread(self):
+        misc._warned_not_main_thread = False
+        entered = []
+
+        warnings = []
+
+        def run():
+            for i in range(2):
+                with misc.time_limit(0.01):
+                    entered.append(True)
+
+        class Logger(object):
+            def warning(self, *args):
+                warnings.append(args)
+
+        logger, misc.logger = misc.logger, Logger()
+        try:
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        finally:
+            misc.logger = logger
+        self.assertEqual(len(entered), 2)
+        self.assertEqual(len(warnings), 1)
+
+    def test_worst_case_mentions(self):
+        links = {'a': '/u/1/', 'a' * 150: '/u/2/'}
+        for content in ('@' * 20000, '@a' * 20000, ('@' + 'a' * 151) * 200):
+            start = time.time()
+            find_mentions(content, 'sender')
+            link_mentions(content + '</p>', links)
+            self.assertLess(time.time() - start, 1)
+
+    def test_fuzz(self):
+        usernames = ['a.b', 'a+b', 'a-b', 'a@b', 'ab']
+        for username in usernames:
+            User.objects.create_user(username=username, email='%s@q.com' % username, password='111')
+        alphabet = ['@', 'a', 'b', '.', '+', '-', '(', ')', '*', '_', '[', ']', '<', '>', '</p>', ' ', '\n']
+        rng = random.Random(2016)
+        for i in range(200):
+            content = ''.join(rng.choice(alphabet) for j in range(rng.randint(0, 200)))
+            rendered, mentioned = render_content(content, 'sender')
+            for linked in re.findall(r'@<a href="/testurlu/\d+/">([^<]*)</a>', rendered):
+                self.assertIn(linked, usernames)
+            for user in mentioned:
+                self.assertIn(user.username, usernames)
+
+
+class AsyncRenderTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.u2 = User.objects.create_user(
+            username='test2', email='2@q.com', password='222'
+        )
+        self.t1 = Topic.objects.create(
+            title='Test Topic 1',
+            user=self.u1,
+            content_raw='This is test topic __1__',
+            node=self.n1,
+        )
+
+    @override_settings(NIJI_ASYNC_RENDER=True, CELERY_ALWAYS_EAGER=False)
+    def test_async_render(self):
+        p = Post.objects.create(
+            topic=self.t1,
+            user=self.u1,
+            content_raw='<i>x</i> __bold__ @test2',
+        )
+        self.assertIn('&lt;i&gt;x&lt;/i&gt; __bold__', p.content_rendered)
+        self.assertTrue(p.is_render_stale())
+        self.assertEqual(self.u2.received_notifications.count(), 0)
+        with self.settings(CELERY_ALWAYS_EAGER=True):
+            self.assertTrue(render('post', p.pk, p.get_content_hash(), True))
+        p = Post.objects.get(pk=p.pk)
+        self.assertIn('<strong>bold</strong>', p.content_rendered)
+        self.assertFalse(p.is_render_stale())
+        self.assertEqual(self.u2.received_notifications.count(), 1)
+        # Outdated tasks are ignored
+        self.assertFalse(render('post', p.pk, 'outdated', True))
+
+    @override_settings(NIJI_ASYNC_RENDER=True)
+    def test_eager_fallback(self):
+        p = Post.objects.create(
+            topic=self.t1,
+            user=self.u1,
+            content_raw='__bold__ @test2',
+        )
+        self.assertIn('<strong>bold</strong>', p.content_rendered)
+        self.assertEqual(self.u2.received_notifications.count(), 1)
+
+
+class MentionResolutionTest(TestCase):
+
+    def setUp(self):
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+
+    def test_cached_resolution(self):
+        with self.assertNumQueries(1):
+            resolved = resolve_mentions(['test1', 'nobody'])
+        self.assertEqual(list(resolved), ['test1'])
+        self.assertEqual(resolved['test1'].pk, self.u1.pk)
+        self.assertEqual(resolved['test1'].url, reverse('niji:user_info', kwargs={'pk': self.u1.pk}))
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_mentions(['test1', 'nobody', 'test1,', '<b>']), resolved)
+
+    def test_invalidation(self):
+        resolve_mentions(['test1', 'test2'])
+        u2 = User.objects.create_user(
+            username='test2', email='2@q.com', password='222'
+        )
+        self.assertEqual(resolve_mentions(['test2'])['test2'].pk, u2.pk)
+        u2.username = 'renamed'
+        u2.save()
+        self.assertEqual(list(resolve_mentions(['test2', 'renamed'])), ['renamed'])
+        u2.delete()
+        self.assertEqual(resolve_mentions(['test2', 'renamed']), {})
+
+
+class ViewCountBufferTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.t1 = Topic.objects.create(title='Test Topic 1', user=self.u1, content_raw='1', node=self.n1)
+        self.t2 = Topic.objects.create(title='Test Topic 2', user=self.u1, content_raw='2', node=self.n1)
+
+    def view_counts(self):
+        return list(Topic.objects.order_by('pk').values_list('view_count', flat=True))
+
+    @override_settings(NIJI_VIEW_COUNT_BUFFER='memory', NIJI_VIEW_COUNT_FLUSH_INTERVAL=3600)
+    def test_memory_buffer(self):
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.t1.increase_view_count()
+            self.t2.increase_view_count()
+        self.assertEqual(self.view_counts(), [0, 0])
+        # Other processes can't reach this buffer
+        with self.assertNumQueries(0):
+            call_command('flush_view_counts', stdout=StringIO())
+        self.assertEqual(flush_view_counts(), 0)
+        with self.assertNumQueries(1):
+            get_view_count_buffer().flush()
+        self.assertEqual(self.view_counts(), [3, 1])
+
+    @override_settings(NIJI_VIEW_COUNT_BUFFER='cache', NIJI_VIEW_COUNT_MAX_BUFFER=3)
+    def test_cache_buffer(self):
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.t1.increase_view_count()
+            self.t2.increase_view_count()
+        self.assertEqual(self.view_counts(), [0, 0])
+        call_command('flush_view_counts', stdout=StringIO())
+        self.assertEqual(self.view_counts(), [3, 1])
+        call_command('flush_view_counts', stdout=StringIO())
+        self.assertEqual(self.view_counts(), [3, 1])
+        self.t1.increase_view_count()
+        self.t2.increase_view_count()
+        t3 = Topic.objects.create(title='Test Topic 3', user=self.u1, content_raw='3', node=self.n1)
+        # Reaching NIJI_VIEW_COUNT_MAX_BUFFER pending topics flushes right away
+        t3.increase_view_count()
+        self.assertEqual(self.view_counts(), [4, 2, 1])
+
+
+class RerenderCommandTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.u2 = User.objects.create_user(
+            username='test2', email='2@q.com', password='222'
+        )
+        self.t1 = Topic.objects.create(
+            title='Test Topic 1',
+            user=self.u1,
+            content_raw='This is test topic __1__',
+            node=self.n1,
+        )
+        for i in range(5):
+            Post.objects.create(
+                topic=self.t1,
+                user=self.u1,
+                content_raw='reply __%s__ to @test2 and @test1' % i,
+            )
+        Topic.objects.update(content_rendered='stale', reply_count=42)
+        Post.objects.update(content_rendered='stale')
+
+    def test_bulk_rerender(self):
+        call_command('rerender', '--all', '--jobs', '1', '--chunk-size', '2', stdout=StringIO())
+        self.assertIn('<strong>1</strong>', Topic.objects.get(pk=self.t1.pk).content_rendered)
+        link = '<a href="%s">test2</a>' % reverse("niji:user_info", kwargs={"pk": self.u2.pk})
+        for post in Post.objects.all():
+            self.assertIn(link, post.content_rendered)
+            self.assertIn('@test1', post.content_rendered)
+            self.assertNotIn('>test1</a>', post.content_rendered)
+        # Save side effects are skipped
+        self.assertEqual(Topic.objects.get(pk=self.t1.pk).reply_count, 42)
+
+    def test_stale_rerender(self):
+        fresh = Post.objects.order_by('pk').first()
+        Post.objects.exclude(pk=fresh.pk).update(renderer_version=0)
+        Topic.objects.update(renderer_version=RENDERER_VERSION)
+        a1 = Appendix.objects.create(topic=self.t1, content_raw='appendix __1__')
+        Appendix.objects.update(content_rendered='stale', renderer_version=0)
+        last_modified = Topic.objects.get(pk=self.t1.pk).last_modified
+        call_command('rerender', '--stale', '--jobs', '1', stdout=StringIO())
+        self.assertEqual(Topic.objects.get(pk=self.t1.pk).content_rendered, 'stale')
+        # Marked as changed for validators, like a saved reply or appendix
+        self.assertGreater(Topic.objects.get(pk=self.t1.pk).last_modified, last_modified)
+        self.assertEqual(Post.objects.get(pk=fresh.pk).content_rendered, 'stale')
+        self.assertEqual(Post.objects.filter(content_rendered='stale').count(), 1)
+        self.assertEqual(Post.objects.filter(renderer_version=RENDERER_VERSION).count(), 5)
+        a1 = Appendix.objects.get(pk=a1.pk)
+        self.assertIn('<strong>1</strong>', a1.content_rendered)
+        self.assertEqual(a1.rendered_hash, a1.raw_content_hash)
+
+    def test_stale_rerender_on_read(self):
+        self.client.get(reverse('niji:topic', kwargs={'pk': self.t1.pk}))
+        self.assertEqual(Topic.objects.get(pk=self.t1.pk).content_rendered, 'stale')
+        Topic.objects.update(renderer_version=0)
+        Post.objects.update(renderer_version=0)
+        response = self.client.get(reverse('niji:topic', kwargs={'pk': self.t1.pk}))
+        self.assertContains(response, '<strong>1</strong>')
+        self.assertFalse(Post.objects.filter(content_rendered='stale').exists())
+        self.assertFalse(Topic.objects.filter(renderer_version=0).exists())
+
+    def test_resume_from_checkpoint(self):
+        last_post = Post.objects.order_by('-pk').first()
+        fd, checkpoint = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'topic': self.t1.pk, 'post': last_post.pk - 1}, f)
+        call_command('rerender', '--all', '--jobs', '1', '--checkpoint', checkpoint, stdout=StringIO())
+        self.assertEqual(Topic.objects.get(pk=self.t1.pk).content_rendered, 'stale')
+        self.assertEqual(Post.objects.filter(content_rendered='stale').count(), 4)
+        self.assertNotEqual(Post.objects.get(pk=last_post.pk).content_rendered, 'stale')
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+class ReplyCountTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.t1 = Topic.objects.create(
+            title='Test Topic 1',
+            user=self.u1,
+            content_raw='This is test topic __1__',
+            node=self.n1,
+        )
+        self.t2 = Topic.objects.create(
+            title='Test Topic 2',
+            user=self.u1,
+            content_raw='This is test topic __2__',
+            node=self.n1,
+        )
+        self.posts = [
+            Post.objects.create(topic=self.t1, user=self.u1, content_raw='reply %s' % i) for i in range(3)
+        ]
+
+    def get_topic(self, topic):
+        return Topic.objects.get(pk=topic.pk)
+
+    def test_hidden_reply(self):
+        Post.objects.create(topic=self.t1, user=self.u1, content_raw='hidden reply', hidden=True)
+        t1 = self.get_topic(self.t1)
+        self.assertEqual(t1.reply_count, 3)
+        self.assertEqual(t1.last_replied, self.posts[-1].pub_date)
+
+    def test_hide_latest_reply(self):
+        latest = self.posts[-1]
+        latest.hidden = True
+        latest.save()
+        t1 = self.get_topic(self.t1)
+        self.assertEqual(t1.reply_count, 2)
+        self.assertEqual(t1.last_replied, self.posts[1].pub_date)
+        latest.hidden = False
+        latest.save()
+        t1 = self.get_topic(self.t1)
+        self.assertEqual(t1.reply_count, 3)
+        self.assertEqual(t1.last_replied, latest.pub_date)
+
+    def test_edit_reply(self):
+        post = Post.objects.select_related('user').get(pk=self.posts[0].pk)
+        post.content_raw = 'edited reply'
+        # The reply itself and the topic's last_modified, topic counters are left alone
+        with self.assertNumQueries(2):
+            post.save(update_fields=['content_raw', 'content_rendered', 'rendered_hash', 'renderer_version'])
+
+    def test_move_reply(self):
+        latest = Post.objects.get(pk=self.posts[-1].pk)
+        latest.topic = self.t2
+        latest.save()
+        t1, t2 = self.get_topic(self.t1), self.get_topic(self.t2)
+        self.assertEqual((t1.reply_count, t1.last_replied), (2, self.posts[1].pub_date))
+        self.assertEqual((t2.reply_count, t2.last_replied), (1, latest.pub_date))
+
+    def test_recount(self):
+        Topic.objects.update(reply_count=42)
+        Topic.objects.filter(pk=self.t1.pk).update(last_replied=self.t1.pub_date)
+        out = StringIO()
+        call_command('recount', '--chunk-size', '1', stdout=out)
+        self.assertIn('Recounted 2 topic(s), fixed 2', out.getvalue())
+        t1, t2 = self.get_topic(self.t1), self.get_topic(self.t2)
+        self.assertEqual((t1.reply_count, t1.last_replied), (3, self.posts[-1].pub_date))
+        self.assertEqual((t2.reply_count, t2.last_replied), (0, t2.pub_date))
+        out = StringIO()
+        call_command('recount', stdout=out)
+        self.assertIn('fixed 0', out.getvalue())
+
+
+class NotificationTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.users = [
+            User.objects.create_user(username='test%s' % i, email='%s@q.com' % i, password='111')
+            for i in range(5)
+        ]
+        self.t1 = Topic.objects.create(
+            title='Test Topic 1',
+            user=self.users[0],
+            content_raw='This is test topic __1__',
+            node=self.n1,
+        )
+
+    def test_single_task_per_save(self):
+        calls = []
+
+        class RecordingTask(object):
+            def delay(self, **kwargs):
+                calls.append(kwargs)
+
+        original, niji_models.notify = niji_models.notify, RecordingTask()
+        try:
+            p = Post.objects.create(topic=self.t1, user=self.users[0], content_raw='@test1 @test2 @test3 @test0')
+        finally:
+            niji_models.notify = original
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0]['sender'], self.users[0].pk)
+        self.assertEqual(calls[0]['post'], p.pk)
+        self.assertEqual(sorted(calls[0]['to']), [u.pk for u in self.users[1:4]])
+
+    def test_duplicates_ignored(self):
+        p = Post.objects.create(topic=self.t1, user=self.users[0], content_raw='@test1')
+        recipients = [u.pk for u in self.users]
+        self.assertEqual(notify(self.users[0].pk, recipients, post=p.pk), 3)
+        self.assertEqual(notify(self.users[0].pk, recipients, post=p.pk), 0)
+        self.assertEqual(Notification.objects.filter(post=p).count(), 4)
+        self.assertFalse(Notification.objects.filter(to=self.users[0]).exists())
+
+    def test_unique_index(self):
+        p = Post.objects.create(topic=self.t1, user=self.users[0], content_raw='@test1')
+        created = Notification.objects.bulk_create_unique([
+            Notification(sender=self.users[0], to=u, post=p) for u in self.users[1:3]
+        ])
+        self.assertEqual(created, 1)
+        self.assertEqual(Notification.objects.filter(post=p).count(), 2)
+
+    def test_deleted_post(self):
+        self.assertEqual(notify(self.users[0].pk, [self.users[1].pk], post=42), 0)
+        self.assertFalse(Notification.objects.exists())
+
+    def test_legacy_arguments(self):
+        notify('test0', 'test1', topic=self.t1.pk)
+        notification = Notification.objects.get(to=self.users[1])
+        self.assertEqual((notification.topic_id, notification.post_id), (self.t1.pk, None))
+
+    def test_purge(self):
+        for i in range(4):
+            Post.objects.create(topic=self.t1, user=self.users[0], content_raw='@test1 @test2 %s' % i)
+        old = timezone.now() - timedelta(days=100)
+        kept = Notification.objects.filter(to=self.users[2]).order_by('pk').first()
+        Notification.objects.exclude(pk=kept.pk).update(pub_date=old)
+        Notification.objects.filter(to=self.users[1]).update(read=True)
+        fd, archive = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        out = StringIO()
+        call_command(
+            'purge_notifications', '--days', '90', '--chunk-size', '3', '--sleep', '0', '--archive', archive,
+            stdout=out
+        )
+        self.assertIn('Deleted 4 read notification(s)', out.getvalue())
+        self.assertFalse(Notification.objects.filter(to=self.users[1]).exists())
+        self.assertEqual(Notification.objects.filter(to=self.users[2]).count(), 4)
+        with open(archive) as f:
+            archived = [json.loads(line) for line in f]
+        os.remove(archive)
+        self.assertEqual([row['to_id'] for row in archived], [self.users[1].pk] * 4)
+        Notification.objects.update(read=True)
+        self.assertEqual(purge_notifications(), 3)
+        self.assertEqual(list(Notification.objects.all()), [kept])
+
+
+class UnreadCountTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.u2 = User.objects.create_user(
+            username='test2', email='2@q.com', password='222'
+        )
+        self.t1 = Topic.objects.create(
+            title='Test Topic 1',
+            user=self.u1,
+            content_raw='This is test topic __1__',
+            node=self.n1,
+        )
+
+    def mention(self, n=1):
+        for i in range(n):
+            Post.objects.create(topic=self.t1, user=self.u1, content_raw='@test2 %s' % i)
+
+    def test_counter(self):
+        self.assertEqual(get_unread_count(self.u2.pk), 0)
+        self.mention(3)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread_count(self.u2.pk), 3)
+        self.client.login(username='test2', password='222')
+        self.client.get(reverse('niji:notifications'))
+        self.assertEqual(get_unread_count(self.u2.pk), 0)
+        self.mention()
+        response = self.client.get(reverse('niji:index'))
+        self.assertEqual(response.context['unread_count'], 1)
+
+    def test_missing_counter(self):
+        self.mention(2)
+        cache.clear()
+        self.assertEqual(get_unread_count(self.u2.pk), 2)
+
+    def test_rebuild(self):
+        self.mention(2)
+        get_unread_count(self.u2.pk)
+        Notification.objects.filter(pk=Notification.objects.first().pk).update(read=True)
+        call_command('rebuild_unread_counts', stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread_count(self.u1.pk), 0)
+            self.assertEqual(get_unread_count(self.u2.pk), 1)
+
+    def test_mark_displayed_page_read(self):
+        self.mention(32)
+        self.client.login(username='test2', password='222')
+        response = self.client.get(reverse('niji:notifications'))
+        self.assertEqual(response.context['unread_count'], 2)
+        self.assertEqual(Notification.objects.filter(read=False).count(), 2)
+        self.client.get(reverse('niji:notifications'))
+        self.assertEqual(Notification.objects.filter(read=False).count(), 2)
+
+    def test_mark_all_read(self):
+        self.mention(32)
+        self.client.login(username='test2', password='222')
+        response = self.client.get(reverse('niji:mark_notifications_read'))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(reverse('niji:mark_notifications_read'))
+        self.assertRedirects(response, reverse('niji:notifications'))
+        self.assertFalse(Notification.objects.filter(read=False).exists())
+        self.assertEqual(get_unread_count(self.u2.pk), 0)
+
+
+class PaginationTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(
+            title='TestNodeOne',
+            description='The first test node'
+        )
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        now = timezone.now()
+        Topic.objects.bulk_create([
+            Topic(
+                title='Topic %s' % i, user=self.u1, node=self.n1, content_raw='topic %s' % i,
+                order=10 if i % 7 else 5
+            )
+            for i in range(95)
+        ])
+        # Pairs of topics share last_replied, told apart by pk. Set afterwards, creating
+        # the rows overwrites it.
+        pks = list(Topic.objects.order_by('pk').values_list('pk', flat=True))
+        for i in range(0, len(pks), 2):
+            Topic.objects.filter(pk__in=pks[i:i + 2]).update(last_replied=now - timedelta(minutes=i // 2))
+        self.assertEqual(Topic.objects.values('last_replied').distinct().count(), 48)
+        self.expected = list(
+            Topic.objects.visible().order_by('order', '-last_replied', '-pk').values_list('pk', flat=True)
+        )
+
+    def walk(self, url, key='after'):
+        pks = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = response.context['page_obj']
+            pks.extend(topic.pk for topic in page.object_list)
+            cursor = page.next_cursor if key == 'after' else page.previous_cursor
+            if cursor:
+                url = '%s?%s=%s' % (reverse('niji:index'), key, cursor)
+            elif key == 'after' and page.has_next():
+                url = reverse('niji:index', kwargs={'page': page.number + 1})
+            else:
+                url = None
+        return pks
+
+    @override_settings(NIJI_PAGINATION_MAX_PAGE=1)
+    def test_cursor_pages(self):
+        self.assertEqual(self.walk(reverse('niji:index')), self.expected)
+        response = self.client.get(reverse('niji:index'))
+        self.assertContains(response, '?after=')
+        last_page = self.client.get('%s?after=%s' % (
+            reverse('niji:index'), response.context['page_obj'].next_cursor
+        ))
+        last_page = self.client.get('%s?after=%s' % (
+            reverse('niji:index'), last_page.context['page_obj'].next_cursor
+        ))
+        backwards = self.walk('%s?before=%s' % (
+            reverse('niji:index'), last_page.context['page_obj'].previous_cursor
+        ), key='before')
+        self.assertEqual(len(backwards), 60)
+        # Each page is in order, pages come from the last one backwards
+        self.assertEqual(backwards[:30], self.expected[30:60])
+        self.assertEqual(backwards[30:], self.expected[:30])
+
+    @override_settings(NIJI_PAGINATION_MAX_PAGE=2)
+    def test_numbered_pages(self):
+        self.assertEqual(self.walk(reverse('niji:index')), self.expected)
+        # Deeper pages are only served by cursor
+        self.assertEqual(self.client.get(reverse('niji:index', kwargs={'page': 3})).status_code, 404)
+        self.assertEqual(self.client.get(reverse('niji:index') + '?page=last').status_code, 404)
+        self.assertEqual(self.client.get(reverse('niji:index') + '?after=garbage').status_code, 404)
+
+    @override_settings(NIJI_PAGINATION_MAX_PAGE=1)
+    def test_ordering(self):
+        url = reverse('niji:index') + '?order=pub_date'
+        response = self.client.get(url)
+        cursor = response.context['page_obj'].next_cursor
+        response = self.client.get(url + '&after=' + cursor)
+        expected = list(Topic.objects.visible().order_by('order', 'pub_date', 'pk').values_list('pk', flat=True))
+        self.assertEqual([t.pk for t in response.context['topics']], expected[30:60])
+
+    @override_settings(NIJI_PAGINATION_COUNT=False)
+    def test_no_count(self):
+        # Cache the sidebar nodes
+        self.client.get(reverse('niji:index'))
+        # Last modified time, topics and avatars, no COUNT
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('niji:index', kwargs={'page': 4}))
+        page = response.context['page_obj']
+        self.assertEqual([t.pk for t in page.object_list], self.expected[90:])
+        self.assertFalse(page.has_next())
+        self.assertEqual(self.client.get(reverse('niji:index', kwargs={'page': 5})).status_code, 404)
+        response = self.client.get(reverse('niji:index', kwargs={'page': 2}))
+        self.assertContains(response, 'href="%s"' % reverse('niji:index', kwargs={'page': 3}))
+
+    def test_topic_view(self):
+        t = Topic.objects.first()
+        Post.objects.bulk_create([
+            Post(topic=t, user=self.u1, content_raw='reply %s' % i) for i in range(40)
+        ])
+        # bulk_create leaves reply_count, which TopicView paginates by
+        call_command('recount', stdout=StringIO())
+        with self.settings(NIJI_PAGINATION_MAX_PAGE=1):
+            response = self.client.get(reverse('niji:topic', kwargs={'pk': t.pk}))
+            response = self.client.get('%s?after=%s' % (
+                reverse('niji:topic', kwargs={'pk': t.pk}), response.context['page_obj'].next_cursor
+            ))
+        self.assertEqual(
+            [p.pk for p in response.context['posts']],
+            list(t.replies.order_by('pub_date', 'pk').values_list('pk', flat=True))[30:]
+        )
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return len([q for q in queries if 'COUNT(' in q['sql']])
+
+    def test_count_sources(self):
+        url = reverse('niji:index')
+        self.assertEqual(self.count_queries(url), 1)
+        with self.settings(NIJI_PAGINATION_COUNT_SOURCE='niji.pagination.cached_count'):
+            cache.clear()
+            self.assertEqual(self.count_queries(url), 1)
+            self.assertEqual(self.count_queries(url), 0)
+            self.assertEqual(self.client.get(url).context['paginator'].count, 95)
+        with self.settings(NIJI_PAGINATION_COUNT_SOURCE='niji.pagination.estimated_count'):
+            # Estimates are PostgreSQL only, counted and cached elsewhere
+            self.assertEqual(self.client.get(url).context['paginator'].count, 95)
+        t = Topic.objects.first()
+        Topic.objects.filter(pk=t.pk).update(reply_count=31)
+        response = self.client.get(reverse('niji:topic', kwargs={'pk': t.pk}))
+        self.assertEqual(response.context['paginator'].num_pages, 2)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Checks SQLite query plans')
+class ListIndexTest(TestCase):
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, view_class, kwargs, query, table, index):
+        view = view_class()
+        view.request = RequestFactory().get('/' + query)
+        view.kwargs = kwargs
+        queryset = view.get_queryset()
+        keys = get_ordering_keys(queryset)
+        values = [timezone.now() if name.endswith('_date') or name == 'last_replied' else 1 for name, descending in keys]
+        cursor_page = queryset.filter(keyset_filter(keys, values)).order_by(
+            *[('-' if descending else '') + name for name, descending in keys]
+        )
+        for page in (queryset[:30], cursor_page[:31]):
+            plan = self.get_plan(page)
+            self.assertIn(table, [line.split()[1] for line in plan])
+            for line in plan:
+                self.assertNotIn('TEMP B-TREE', line)
+                if line.split()[1] == table:
+                    self.assertIn('USING INDEX %s ' % index, line)
+
+    def test_list_queries(self):
+        self.assertUsesIndex(Index, {}, '', 'niji_topic', 'niji_topic_list_replied')
+        self.assertUsesIndex(Index, {}, '?order=-pub_date', 'niji_topic', 'niji_topic_list_pub')
+        self.assertUsesIndex(NodeView, {'pk': 1}, '', 'niji_topic', 'niji_topic_node_replied')
+        self.assertUsesIndex(NodeView, {'pk': 1}, '?order=-pub_date', 'niji_topic', 'niji_topic_node_pub')
+        self.assertUsesIndex(UserTopics, {'pk': 1}, '', 'niji_topic', 'niji_topic_user_pub')
+        self.assertUsesIndex(TopicView, {'pk': 1}, '', 'niji_post', 'niji_post_topic_pub')
+
+
+class NodeStatsTest(TestCase):
+
+    def setUp(self):
+        self.n1 = Node.objects.create(title='TestNodeOne')
+        self.n2 = Node.objects.create(title='TestNodeTwo')
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.topics = [
+            Topic.objects.create(title='Topic %s' % i, user=self.u1, node=self.n1, content_raw='topic %s' % i)
+            for i in range(3)
+        ]
+        for topic in self.topics[:2]:
+            Post.objects.create(topic=topic, user=self.u1, content_raw='reply')
+
+    def get_stats(self, node):
+        node = Node.objects.get(pk=node.pk)
+        return node.topic_count, node.visible_topic_count, node.post_count, node.last_activity
+
+    def assertStats(self, node, topics, visible_topics, posts):
+        stats = self.get_stats(node)
+        self.assertEqual(stats[:3], (topics, visible_topics, posts))
+        # Same as counted from scratch
+        self.assertEqual(recount_nodes(), 0)
+        self.assertEqual(self.get_stats(node), stats)
+
+    def test_incremental(self):
+        self.assertStats(self.n1, 3, 3, 2)
+        latest = self.topics[-1]
+        self.assertEqual(self.get_stats(self.n1)[3], Topic.objects.get(pk=self.topics[1].pk).last_replied)
+        latest.hidden = True
+        latest.save()
+        self.assertStats(self.n1, 3, 2, 2)
+        topic = Topic.objects.get(pk=self.topics[0].pk)
+        topic.node = self.n2
+        topic.save()
+        self.assertStats(self.n1, 2, 1, 1)
+        self.assertStats(self.n2, 1, 1, 1)
+        Topic.objects.filter(node=self.n1).delete()
+        self.assertStats(self.n1, 0, 0, 0)
+        self.assertIsNone(self.get_stats(self.n1)[3])
+        Post.objects.create(topic=topic, user=self.u1, content_raw='reply')
+        self.assertStats(self.n2, 1, 1, 2)
+
+    def test_bulk_deleted_replies(self):
+        topic = self.topics[0]
+        Post.objects.create(topic=topic, user=self.u1, content_raw='reply')
+        self.assertStats(self.n1, 3, 3, 3)
+        # e.g. deleted from the admin
+        Post.objects.filter(topic=topic).delete()
+        topic = Topic.objects.get(pk=topic.pk)
+        self.assertEqual((topic.reply_count, topic.last_replied), (0, topic.pub_date))
+        self.assertStats(self.n1, 3, 3, 1)
+        # Along with its topic, a reply is taken off the node once
+        self.topics[1].delete()
+        self.assertStats(self.n1, 2, 2, 0)
+
+    def test_recount(self):
+        Node.objects.update(topic_count=42, post_count=42, last_activity=None)
+        out = StringIO()
+        call_command('recount', stdout=out)
+        self.assertIn('Recounted 2 node(s), fixed 2', out.getvalue())
+        self.assertStats(self.n1, 3, 3, 2)
+        self.assertStats(self.n2, 0, 0, 0)
+
+    def test_no_queries(self):
+        node = Node.objects.get(pk=self.n1.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(NodeAdmin(Node, admin.site).number_of_topics(node), '3(3)')
+        response = self.client.get(reverse('niji:node', kwargs={'pk': self.n1.pk}))
+        self.assertEqual(response.context['paginator'].count, 3)
+        self.assertContains(response, '3 topics')
+
+
+class RowCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.n1 = Node.objects.create(title='TestNodeOne')
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.t1 = Topic.objects.create(title='Old title', user=self.u1, node=self.n1, content_raw='topic')
+        Topic.objects.update(last_replied=timezone.now() - timedelta(hours=2))
+
+    def get_index(self):
+        return self.client.get(reverse('niji:index')).content.decode('utf-8')
+
+    def test_row_cached(self):
+        self.assertIn('Old title', self.get_index())
+        Topic.objects.update(title='New title')
+        self.assertIn('Old title', self.get_index())
+        Topic.objects.get(pk=self.t1.pk).save()
+        self.assertIn('New title', self.get_index())
+        Topic.objects.update(title='Newer title')
+        ForumAvatar(user=self.u1).save()
+        self.assertIn('Newer title', self.get_index())
+
+    def test_young_rows_not_cached(self):
+        Topic.objects.update(last_replied=timezone.now())
+        self.get_index()
+        Topic.objects.update(title='New title')
+        self.assertIn('New title', self.get_index())
+
+    def test_rows_share_request_avatars(self):
+        response = self.client.get(reverse('niji:index'))
+        self.assertIn(self.u1.pk, response.wsgi_request._niji_avatar_resolver._infos)
+
+    @override_settings(NIJI_ROW_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        self.get_index()
+        Topic.objects.update(title='New title')
+        self.assertIn('New title', self.get_index())
+
+    def test_time_bucket(self):
+        now = timezone.now()
+        self.assertIsNone(time_bucket(now - timedelta(seconds=30), now))
+        self.assertTrue(time_bucket(now - timedelta(minutes=5), now).startswith('60/'))
+        self.assertTrue(time_bucket(now - timedelta(hours=5), now).startswith('3600/'))
+        # "5 days, 3 hours ago" changes every hour
+        self.assertTrue(time_bucket(now - timedelta(days=5, hours=3), now).startswith('3600/'))
+        self.assertTrue(time_bucket(now - timedelta(days=10), now).startswith('86400/'))
+
+
+@override_settings(NIJI_PAGE_CACHE_TIMEOUT=60)
+class PageCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.n1 = Node.objects.create(title='TestNodeOne')
+        self.n2 = Node.objects.create(title='TestNodeTwo')
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.t1 = Topic.objects.create(title='Old title', user=self.u1, node=self.n1, content_raw='topic')
+        self.t2 = Topic.objects.create(title='Other title', user=self.u1, node=self.n2, content_raw='topic')
+
+    def get(self, url):
+        return self.client.get(url).content.decode('utf-8')
+
+    def test_anonymous_served_from_cache(self):
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        self.get(url)
+        with self.assertNumQueries(2):
+            # The last modified time and the view count
+            self.assertIn('Old title', self.get(url))
+        self.assertEqual(Topic.objects.get(pk=self.t1.pk).view_count, 2)
+        Topic.objects.update(title='New title')
+        self.assertIn('Old title', self.get(url))
+        self.client.login(username='test1', password='111')
+        self.assertIn('New title', self.get(url))
+
+    def test_keyed_by_ordering(self):
+        self.get(reverse('niji:index'))
+        Topic.objects.update(title='New title')
+        self.assertIn('New title', self.get(reverse('niji:index') + '?order=pub_date'))
+
+    def test_versions(self):
+        index, node1, node2, topic1 = (
+            reverse('niji:index'),
+            reverse('niji:node', kwargs={'pk': self.n1.pk}),
+            reverse('niji:node', kwargs={'pk': self.n2.pk}),
+            reverse('niji:topic', kwargs={'pk': self.t1.pk}),
+        )
+        for url in (index, node1, node2, topic1):
+            self.get(url)
+        Topic.objects.update(title='New title')
+        Post.objects.create(topic=self.t1, user=self.u1, content_raw='reply')
+        self.assertIn('New title', self.get(index))
+        self.assertIn('New title', self.get(node1))
+        self.assertIn('New title', self.get(topic1))
+        self.assertIn('Other title', self.get(node2))
+        Node.objects.filter(pk=self.n1.pk).update(title='New node title')
+        Node.objects.get(pk=self.n2.pk).save()
+        self.assertIn('New node title', self.get(node2))
+
+    def test_user_changes(self):
+        index = reverse('niji:index')
+        self.get(index)
+        Topic.objects.update(title='New title')
+        # Neither shows on any page
+        User.objects.create_user(username='test2', email='2@q.com', password='222')
+        user = User.objects.get(pk=self.u1.pk)
+        user.first_name = 'First'
+        user.save()
+        self.assertIn('Old title', self.get(index))
+        user.username = 'renamed'
+        user.save()
+        self.assertIn('New title', self.get(index))
+
+    def test_csrf_pages_not_cached(self):
+        url = reverse('niji:index')
+
+        def get_request():
+            request = RequestFactory().get(url)
+            request.user = AnonymousUser()
+            request.resolver_match = resolve(url)
+            return request
+
+        request = get_request()
+        # e.g. a login form in a customized template
+        get_token(request)
+        Index.as_view()(request).render()
+        # Rendered again rather than served from the cache
+        self.assertTrue(hasattr(Index.as_view()(get_request()), 'render'))
+
+    @override_settings(NIJI_PAGE_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        self.get(url)
+        Topic.objects.update(title='New title')
+        self.assertIn('New title', self.get(url))
+
+
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.n1 = Node.objects.create(title='TestNodeOne')
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+        self.t1 = Topic.objects.create(title='Topic', user=self.u1, node=self.n1, content_raw='topic')
+        self.p1 = Post.objects.create(topic=self.t1, user=self.u1, content_raw='reply')
+
+    def assertNotModified(self, url, response, queries=1):
+        with self.assertNumQueries(queries):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def assertModified(self, url, response):
+        new_response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(new_response.status_code, 200)
+        return new_response
+
+    def test_topic(self):
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        response = self.client.get(url)
+        # The last modified time and the view count, counted like on a full page
+        self.assertNotModified(url, response, queries=2)
+        self.assertEqual(Topic.objects.get(pk=self.t1.pk).view_count, 2)
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304
+        )
+        post = Post.objects.get(pk=self.p1.pk)
+        post.content_raw = 'edited'
+        post.save()
+        response = self.assertModified(url, response)
+        Appendix.objects.create(topic=self.t1, content_raw='appendix')
+        response = self.assertModified(url, response)
+        Post.objects.create(topic=self.t1, user=self.u1, content_raw='reply')
+        self.assertModified(url, response)
+
+    @override_settings(
+        NIJI_ASYNC_RENDER=True, CELERY_ALWAYS_EAGER=False, NIJI_RERENDER_STALE_ON_READ=False,
+        NIJI_PAGE_CACHE_TIMEOUT=60
+    )
+    def test_async_render(self):
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        post = Post.objects.create(topic=self.t1, user=self.u1, content_raw='__rendered__')
+        response = self.client.get(url)
+        self.assertNotContains(response, '<strong>rendered</strong>')
+        with self.settings(CELERY_ALWAYS_EAGER=True):
+            self.assertTrue(render('post', post.pk, post.get_content_hash()))
+        # Neither answered 304 nor served from the page cache
+        response = self.assertModified(url, response)
+        self.assertContains(response, '<strong>rendered</strong>')
+
+    def test_lists(self):
+        index, node = reverse('niji:index'), reverse('niji:node', kwargs={'pk': self.n1.pk})
+        responses = [self.client.get(index), self.client.get(node)]
+        self.assertNotModified(index, responses[0])
+        self.assertNotModified(node, responses[1])
+        topic = Topic.objects.get(pk=self.t1.pk)
+        topic.title = 'Renamed'
+        topic.save()
+        responses = [self.assertModified(index, responses[0]), self.assertModified(node, responses[1])]
+        Post.objects.create(topic=self.t1, user=self.u1, content_raw='reply')
+        self.assertModified(index, responses[0])
+        self.assertModified(node, responses[1])
+
+    def test_site_changes(self):
+        index, topic = reverse('niji:index'), reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        old = [self.client.get(index), self.client.get(topic)]
+        # Shown on every page without moving any topic or node
+        user = User.objects.get(pk=self.u1.pk)
+        user.username = 'renamed'
+        user.save()
+        new = [self.assertModified(index, old[0]), self.assertModified(topic, old[1])]
+        # Without the page cache too
+        with self.settings(NIJI_PAGE_CACHE_TIMEOUT=0):
+            NodeGroup.objects.create(title='Group')
+            self.assertModified(index, new[0])
+            self.assertModified(topic, new[1])
+
+    def test_recount(self):
+        Topic.objects.update(reply_count=42)
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        response = self.client.get(url)
+        call_command('recount', stdout=StringIO())
+        self.assertModified(url, response)
+
+    def test_renderer_version(self):
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        response = self.client.get(url)
+        version, conditional.RENDERER_VERSION = conditional.RENDERER_VERSION, conditional.RENDERER_VERSION + 1
+        try:
+            self.assertModified(url, response)
+        finally:
+            conditional.RENDERER_VERSION = version
+
+    def test_authenticated(self):
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        response = self.client.get(url)
+        self.client.login(username='test1', password='111')
+        response = self.assertModified(url, response)
+        self.assertFalse(response.has_header('Last-Modified'))
+        Notification.objects.create(sender=self.u1, to=self.u1, topic=self.t1)
+        self.assertModified(url, response)
+
+    def test_api(self):
+        User.objects.create_superuser(username='super', email='super@example.com', password='123')
+        self.client.login(username='super', password='123')
+        topic_url = api_reverse('niji:topic-detail', kwargs={'pk': self.t1.pk})
+        post_url = api_reverse('niji:post-detail', kwargs={'pk': self.p1.pk})
+        responses = [self.client.get(topic_url), self.client.get(post_url)]
+        # Session, user and the object
+        self.assertNotModified(topic_url, responses[0], queries=3)
+        self.assertNotModified(post_url, responses[1], queries=3)
+        post = Post.objects.get(pk=self.p1.pk)
+        post.hidden = True
+        post.save()
+        self.assertModified(topic_url, responses[0])
+        self.assertModified(post_url, responses[1])
+
+
+class NodeRegistryTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.n1 = Node.objects.create(title='TestNodeOne')
+        self.n2 = Node.objects.create(title='TestNodeTwo')
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+
+    def get_node_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            content = self.client.get(url).content.decode('utf-8')
+        return content, [q['sql'] for q in queries if '"niji_node"."title"' in q['sql']]
+
+    def test_sidebar(self):
+        content, queries = self.get_node_queries(reverse('niji:index'))
+        self.assertIn('TestNodeOne', content)
+        self.assertTrue(queries)
+        content, queries = self.get_node_queries(reverse('niji:index'))
+        self.assertIn('TestNodeOne', content)
+        self.assertEqual(queries, [])
+
+    def test_invalidation(self):
+        self.client.get(reverse('niji:index'))
+        self.n1.title = 'Renamed'
+        self.n1.save()
+        self.assertContains(self.client.get(reverse('niji:index')), 'Renamed')
+        group = NodeGroup.objects.create(title='TestGroup')
+        group.node.add(self.n2)
+        content = self.client.get(reverse('niji:index')).content.decode('utf-8')
+        self.assertIn('TestGroup', content)
+        self.assertLess(content.index('TestGroup'), content.index('TestNodeTwo'))
+        self.assertLess(content.index('TestNodeTwo'), content.index('Renamed'))
+        self.n2.delete()
+        self.assertNotContains(self.client.get(reverse('niji:index')), 'TestNodeTwo')
+
+    def test_form_choices(self):
+        self.client.login(username='test1', password='111')
+        self.client.get(reverse('niji:create_topic'))
+        content, queries = self.get_node_queries(reverse('niji:create_topic'))
+        self.assertIn('<option value="%s">TestNodeTwo</option>' % self.n2.pk, content)
+        self.assertEqual(queries, [])
+        self.client.post(reverse('niji:create_topic'), {
+            'node': self.n2.pk, 'title': 'Topic', 'content_raw': 'topic'
+        })
+        self.assertEqual(Topic.objects.get().node, self.n2)
+
+
+class TopicPageQueriesTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.n1 = Node.objects.create(title='TestNodeOne')
+        self.users = [
+            User.objects.create_user(username='test%s' % i, email='%s@q.com' % i, password='111')
+            for i in range(5)
+        ]
+        for user in self.users[:2]:
+            ForumAvatar(user=user).save()
+        self.t1 = Topic.objects.create(title='Topic', user=self.users[0], node=self.n1, content_raw='topic')
+        for i in range(30):
+            Post.objects.create(topic=self.t1, user=self.users[i % 5], content_raw='reply %s' % i)
+
+    def assertQueries(self, appendices):
+        for i in range(appendices):
+            Appendix.objects.create(topic=self.t1, content_raw='appendix %s' % i)
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        # Cache the sidebar nodes
+        self.client.get(url)
+        # Topic with node, author and avatar, view count, appendices, replies with authors and avatars
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['appendices']), appendices)
+
+    def test_no_appendices(self):
+        self.assertQueries(0)
+
+    def test_appendices(self):
+        self.assertQueries(5)
+
+    def test_reply(self):
+        self.client.login(username='test1', password='111')
+        url = reverse('niji:topic', kwargs={'pk': self.t1.pk})
+        self.assertRedirects(self.client.post(url, {'content_raw': 'new reply'}), url)
+        self.assertEqual(Topic.objects.get(pk=self.t1.pk).reply_count, 31)
+
+
+class AvatarTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            User.objects.create_user(username='test%s' % i, email='%s@Q.com' % i, password='111')
+            for i in range(5)
+        ]
+        ForumAvatar(user=self.users[0]).save()
+
+    def test_gravatar_hash(self):
+        avatar = ForumAvatar.objects.get(user=self.users[0])
+        self.assertEqual(avatar.gravatar_hash, hashlib.md5(b'0@q.com').hexdigest())
+        self.users[0].email = 'new@q.com'
+        self.users[0].save()
+        avatar = ForumAvatar.objects.get(user=self.users[0])
+        self.assertEqual(avatar.gravatar_hash, hashlib.md5(b'new@q.com').hexdigest())
+
+    def test_resolver(self):
+        users = [User.objects.get(pk=user.pk) for user in self.users] * 6
+        resolver = AvatarResolver()
+        # One avatar lookup per distinct user
+        with self.assertNumQueries(5):
+            urls = [resolver.url(user) for user in users]
+        self.assertIn(hashlib.md5(b'1@q.com').hexdigest(), urls[1])
+        resolver = AvatarResolver()
+        with self.assertNumQueries(0):
+            self.assertEqual([resolver.url(user) for user in users], urls)
+        # Loaded along with the users
+        users = list(User.objects.select_related('forum_avatar'))
+        resolver = AvatarResolver()
+        cache.clear()
+        with self.assertNumQueries(0):
+            [resolver.url(user) for user in users]
+
+    def test_invalidation(self):
+        resolver = AvatarResolver()
+        resolver.url(self.users[1])
+        ForumAvatar(user=self.users[1]).save()
+        self.assertIsNone(cache.get('niji:avatar:%s' % self.users[1].pk))
+        resolver.url(self.users[1])
+        self.users[1].email = 'new@q.com'
+        self.users[1].save()
+        user = User.objects.get(pk=self.users[1].pk)
+        self.assertIn(hashlib.md5(b'new@q.com').hexdigest(), AvatarResolver().url(user))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), NIJI_AVATAR_SIZES=(28, 48, 120))
+class AvatarProcessingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.u1 = User.objects.create_user(
+            username='test1', email='1@q.com', password='111'
+        )
+
+    def upload(self, color='red', name='avatar.png', user=None):
+        buf = BytesIO()
+        Image.new('RGB', (300, 200), color).save(buf, format='PNG')
+        avatar = ForumAvatar(user=user or self.u1, image=SimpleUploadedFile(name, buf.getvalue()))
+        avatar.save()
+        return avatar
+
+    def get_url(self, size):
+        return AvatarResolver().url(User.objects.get(pk=self.u1.pk), size)
+
+    def get_thumbnails(self, user):
+        return json.loads(ForumAvatar.objects.get(user=user).thumbnails).values()
+
+    def test_process(self):
+        avatar = self.upload()
+        # The original is stored until processed, but never shown
+        self.assertEqual(Image.open(avatar.image.path).size, (300, 200))
+        self.assertIn('gravatar.com', self.get_url(48))
+        self.assertTrue(process_avatar(avatar.pk, avatar.image.name))
+        thumbnails = json.loads(ForumAvatar.objects.get(pk=avatar.pk).thumbnails)
+        self.assertEqual(sorted(thumbnails), ['120', '28', '48'])
+        for size, name in thumbnails.items():
+            self.assertEqual(max(Image.open(avatar.image.storage.path(name)).size), int(size))
+        self.assertIn(thumbnails['48'], self.get_url(48))
+        self.assertIn(thumbnails['120'], self.get_url(100))
+        self.assertIn(thumbnails['120'], self.get_url(200))
+
+    def test_content_hashed_names(self):
+        first = self.upload()
+        process_avatar(first.pk, first.image.name)
+        second = self.upload()
+        self.assertEqual(ForumAvatar.objects.count(), 1)
+        self.assertEqual(ForumAvatar.objects.get().thumbnails, '')
+        # Same content, same original and thumbnails
+        self.assertEqual(second.image.name, first.image.name)
+        process_avatar(second.pk, second.image.name)
+        thumbnails = ForumAvatar.objects.get().thumbnails
+        self.assertIn(xxhash.xxh64(open(first.image.path, 'rb').read()).hexdigest(), thumbnails)
+        third = self.upload('blue')
+        # Replaced since queued
+        self.assertFalse(process_avatar(third.pk, first.image.name))
+        process_avatar(third.pk, third.image.name)
+        self.assertNotEqual(ForumAvatar.objects.get().thumbnails, thumbnails)
+
+    def test_upload_names(self):
+        # e.g. an image that is also valid HTML
+        avatar = self.upload(name='avatar.html')
+        digest = xxhash.xxh64(open(avatar.image.path, 'rb').read()).hexdigest()
+        self.assertEqual(avatar.image.name, 'uploads/forum/avatars/%s.png' % digest)
+        self.assertEqual(self.upload(name='other.svg').image.name, avatar.image.name)
+        with self.assertRaises(ValidationError):
+            ForumAvatar(user=self.u1, image=SimpleUploadedFile('avatar.png', b'<html></html>')).save()
+        form = ForumAvatarForm(
+            {}, {'image': SimpleUploadedFile('avatar.png', b'<svg onload="alert(1)"/>')}, user=self.u1
+        )
+        self.assertIn('image', form.errors)
+
+    def test_replaced_thumbnails_deleted(self):
+        u2 = User.objects.create_user(username='test2', email='2@q.com', password='222')
+        for user in (self.u1, u2):
+            avatar = self.upload(user=user)
+            process_avatar(avatar.pk, avatar.image.name)
+        red = list(self.get_thumbnails(self.u1))
+        storage = avatar.image.storage
+        # Queued by save once committed, which tests don't
+        avatar = self.upload('blue')
+        process_avatar(avatar.pk, avatar.image.name, red)
+        # Still used by the other user
+        self.assertTrue(all(storage.exists(name) for name in red))
+        avatar = self.upload('green', user=u2)
+        process_avatar(avatar.pk, avatar.image.name, red)
+        self.assertFalse(any(storage.exists(name) for name in red))
+        self.assertTrue(all(storage.exists(name) for name in self.get_thumbnails(self.u1)))
+
+    def test_save_without_new_image(self):
+        avatar = self.upload()
+        process_avatar(avatar.pk, avatar.image.name)
+        avatar = ForumAvatar.objects.get(pk=avatar.pk)
+        avatar.use_gravatar = True
+        avatar.save()
+        self.assertNotEqual(ForumAvatar.objects.get(pk=avatar.pk).thumbnails, '')
+
+
 class VisitorTest(LiveServerTestCase):
     """
     Test as a visitor (unregistered user)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import caches
+
+
+def _get_cache():
+    return caches[getattr(settings, 'NIJI_UNREAD_CACHE_ALIAS', 'default')]
+
+
+def _get_timeout():
+    # Bounds how long a drifted counter can live
+    return getattr(settings, 'NIJI_UNREAD_CACHE_TIMEOUT', 86400)
+
+
+def _key(user_id):
+    return 'niji:unread:%s' % user_id
+
+
+def get_unread_count(user_id):
+    """
+    :param user_id: pk of the user
+    :return: number of unread notifications, counted only if the counter is missing
+    """
+    cache = _get_cache()
+    count = cache.get(_key(user_id))
+    if count is None:
+        from niji.models import Notification
+        count = Notification.objects.filter(to_id=user_id, read=False).count()
+        cache.add(_key(user_id), count, _get_timeout())
+    return count
+
+
+def add_unread(counts):
+    """
+    Count newly created unread notifications
+    :param counts: dict of user id -> notifications created
+    """
+    cache = _get_cache()
+    for user_id, n in counts.items():
+        try:
+            cache.incr(_key(user_id), n)
+        except ValueError:
+            # Not counted yet, the next read counts from the table
+            pass
+
+
+def mark_read(user_id, n=None):
+    """
+    Count notifications marked as read
+    :param user_id: pk of the user
+    :param n: number of notifications marked as read, None if all of them were
+    """
+    cache = _get_cache()
+    if n is None:
+        cache.set(_key(user_id), 0, _get_timeout())
+        return
+    if not n:
+        return
+    try:
+        if cache.decr(_key(user_id), n) < 0:
+            cache.delete(_key(user_id))
+    except ValueError:
+        pass
+
+
+def rebuild_unread_counts(user_ids):
+    """
+    Reset the counters of users from their notifications with one grouped aggregate
+    :param user_ids: list of user ids
+    """
+    from django.db.models import Count
+    from niji.models import Notification
+    counts = dict.fromkeys(user_ids, 0)
+    counts.update(
+        Notification.objects.filter(to_id__in=user_ids, read=False).order_by().values_list('to_id').annotate(
+            count=Count('pk')
+        )
+    )
+    _get_cache().set_many(dict((_key(user_id), n) for user_id, n in counts.items()), _get_timeout())
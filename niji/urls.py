@@ -28,7 +28,9 @@ urlpatterns = [
     url(r'^search/(?P<keyword>.*?)/page/(?P<page>[0-9]+)/$', views.SearchView.as_view(), name='search'),
     url(r'^search/(?P<keyword>.*?)/$', views.SearchView.as_view(), name='search'),
     url(r'^t/create/$', views.create_topic, name='create_topic'),
+    url(r'^notifications/page/(?P<page>[0-9]+)/$', views.NotificationView.as_view(), name='notifications'),
     url(r'^notifications/$', views.NotificationView.as_view(), name='notifications'),
+    url(r'^notifications/read/$', views.mark_notifications_read, name='mark_notifications_read'),
     url(r'^avatar/$', views.upload_avatar, name="upload_avatar"),
     url(r'^api/', include(api_router.urls)),
 ]
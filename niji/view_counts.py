@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import models
+from django.db.models import F, Case, When, Value
+from django.dispatch import receiver
+import atexit
+import threading
+import time
+
+
+def apply_view_counts(counts):
+    """
+    Add buffered views to topics with a single UPDATE
+    :param counts: dict of topic id -> views to add
+    :return: number of topics updated
+    """
+    from niji.models import Topic
+    counts = dict((pk, n) for pk, n in counts.items() if n)
+    if not counts:
+        return 0
+    return Topic.objects.filter(pk__in=list(counts)).update(
+        view_count=F('view_count') + Case(
+            *[When(pk=pk, then=Value(n)) for pk, n in counts.items()],
+            default=Value(0),
+            output_field=models.IntegerField()
+        )
+    )
+
+
+class MemoryViewCountBuffer(object):
+    """
+    Buffers views in process memory, each process flushes its own buffer
+    once ``flush_interval`` seconds passed or ``max_size`` topics are pending,
+    and when it exits. Other processes can't flush it.
+    """
+    # Whether other processes, e.g. the flush_view_counts command, can flush the buffer
+    shared = False
+
+    def __init__(self, flush_interval=60, max_size=1000):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def add(self, topic_id):
+        with self._lock:
+            self._counts[topic_id] = self._counts.get(topic_id, 0) + 1
+            due = len(self._counts) >= self.max_size or time.time() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._last_flush = time.time()
+        return apply_view_counts(counts)
+
+
+class CacheViewCountBuffer(object):
+    """
+    Buffers views in a Django cache shared by all processes, flushed by the
+    ``flush_view_counts`` task or management command, or by whichever request
+    finds ``max_size`` topics pending.
+
+    Topics are registered in numbered slots the first time they are viewed
+    after a flush. Views landing between reading and clearing a topic's
+    counter during a flush are lost, counts are approximate.
+    """
+    prefix = 'niji:views'
+    shared = True
+
+    def __init__(self, flush_interval=60, max_size=1000, cache_alias='default'):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _incr(self, key, timeout=None):
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            if self.cache.add(key, 1, timeout):
+                return 1
+            return self.cache.incr(key)
+
+    def add(self, topic_id):
+        cache = self.cache
+        key = '%s:topic:%s' % (self.prefix, topic_id)
+        # Counters outlive a few missed flushes, but can't get stuck unregistered
+        timeout = self.flush_interval * 10
+        if cache.add(key, 1, timeout):
+            slot = self._incr('%s:slots' % self.prefix)
+            cache.set('%s:slot:%s' % (self.prefix, slot), topic_id, timeout)
+            if slot - cache.get('%s:flushed' % self.prefix, 0) >= self.max_size:
+                self.flush()
+        else:
+            try:
+                cache.incr(key)
+            except ValueError:
+                # Expired in between
+                cache.add(key, 1, timeout)
+
+    def flush(self):
+        cache = self.cache
+        lock = '%s:flush-lock' % self.prefix
+        if not cache.add(lock, True, self.flush_interval):
+            return 0
+        try:
+            flushed = cache.get('%s:flushed' % self.prefix, 0)
+            current = cache.get('%s:slots' % self.prefix, 0)
+            if current < flushed:
+                # The slot counter was evicted and started over
+                flushed = 0
+            if current <= flushed:
+                return 0
+            slot_keys = ['%s:slot:%s' % (self.prefix, slot) for slot in range(flushed + 1, current + 1)]
+            topic_ids = set(cache.get_many(slot_keys).values())
+            count_keys = dict(('%s:topic:%s' % (self.prefix, pk), pk) for pk in topic_ids)
+            counts = dict((count_keys[key], n) for key, n in cache.get_many(list(count_keys)).items())
+            cache.delete_many(slot_keys + list(count_keys))
+            cache.set('%s:flushed' % self.prefix, current, None)
+            return apply_view_counts(counts)
+        finally:
+            cache.delete(lock)
+
+
+_buffer = None
+
+
+def get_view_count_buffer():
+    """
+    :return: the configured view count buffer, None if views are counted immediately
+    """
+    global _buffer
+    mode = getattr(settings, 'NIJI_VIEW_COUNT_BUFFER', None)
+    if mode is None:
+        return None
+    if _buffer is None:
+        flush_interval = getattr(settings, 'NIJI_VIEW_COUNT_FLUSH_INTERVAL', 60)
+        max_size = getattr(settings, 'NIJI_VIEW_COUNT_MAX_BUFFER', 1000)
+        if mode == 'memory':
+            _buffer = MemoryViewCountBuffer(flush_interval, max_size)
+            atexit.register(_buffer.flush)
+        elif mode == 'cache':
+            _buffer = CacheViewCountBuffer(
+                flush_interval, max_size, getattr(settings, 'NIJI_VIEW_COUNT_CACHE_ALIAS', 'default')
+            )
+        else:
+            raise ImproperlyConfigured("NIJI_VIEW_COUNT_BUFFER must be None, 'memory' or 'cache'")
+    return _buffer
+
+
+@receiver(setting_changed)
+def _reset_view_count_buffer(sender, setting, **kwargs):
+    global _buffer
+    if setting.startswith('NIJI_VIEW_COUNT'):
+        _buffer = None
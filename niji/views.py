@@ -7,12 +7,18 @@ from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.views.generic import ListView
+from django.db.models import Max
 from django.utils.translation import ugettext as _
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 from .models import Topic, Node, Post, Notification, ForumAvatar
 from .forms import TopicForm, TopicEditForm, AppendixForm, ForumAvatarForm, ReplyForm
 from .misc import get_query
+from .pagination import KeysetPaginationMixin, with_tie_break
+from .page_cache import AnonymousPageCacheMixin, ALL_NODES, SITE
+from .conditional import ConditionalGetMixin
+from .unread import mark_read
+import itertools
 import re
 
 EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
@@ -35,21 +41,31 @@ def get_topic_ordering(request):
 
 
 # Create your views here.
-class Index(ListView):
+class Index(ConditionalGetMixin, AnonymousPageCacheMixin, KeysetPaginationMixin, ListView):
     model = Topic
     paginate_by = 30
     template_name = 'niji/index.html'
     context_object_name = 'topics'
 
+    def get_ordering(self):
+        return get_topic_ordering(self.request)
+
     def get_queryset(self):
         return Topic.objects.visible().select_related(
             'user', 'node'
         ).prefetch_related(
             'user__forum_avatar'
         ).order_by(
-            *['order', get_topic_ordering(self.request)]
+            *with_tie_break(['order', self.get_ordering()])
         )
 
+    def get_page_cache_versions(self):
+        return [SITE, ALL_NODES]
+
+    def get_last_modified(self):
+        # Nodes are marked as modified along with their topics
+        return Node.objects.aggregate(last_modified=Max('last_modified'))['last_modified']
+
     def get_context_data(self, **kwargs):
         context = super(ListView, self).get_context_data(**kwargs)
         context['panel_title'] = _('New Topics')
@@ -58,12 +74,15 @@ class Index(ListView):
         return context
 
 
-class NodeView(ListView):
+class NodeView(ConditionalGetMixin, AnonymousPageCacheMixin, KeysetPaginationMixin, ListView):
     model = Topic
     paginate_by = 30
     template_name = 'niji/node.html'
     context_object_name = 'topics'
 
+    def get_ordering(self):
+        return get_topic_ordering(self.request)
+
     def get_queryset(self):
         return Topic.objects.visible().filter(
             node__id=self.kwargs.get('pk')
@@ -72,18 +91,33 @@ class NodeView(ListView):
         ).prefetch_related(
             'user__forum_avatar'
         ).order_by(
-            *['order', get_topic_ordering(self.request)]
+            *with_tie_break(['order', self.get_ordering()])
         )
 
+    def get_page_cache_versions(self):
+        return [SITE, ('node', self.kwargs.get('pk'))]
+
+    def get_last_modified(self):
+        return self.get_node().last_modified
+
+    def get_node(self):
+        if not hasattr(self, 'node'):
+            self.node = Node.objects.get(pk=self.kwargs.get('pk'))
+        return self.node
+
+    def get_pagination_count(self, queryset):
+        # Visible topics are counted on the node
+        return self.get_node().visible_topic_count
+
     def get_context_data(self, **kwargs):
         context = super(ListView, self).get_context_data(**kwargs)
-        context['node'] = node = Node.objects.get(pk=self.kwargs.get('pk'))
+        context['node'] = node = self.get_node()
         context['title'] = context['panel_title'] = node.title
         context['show_order'] = True
         return context
 
 
-class TopicView(ListView):
+class TopicView(ConditionalGetMixin, AnonymousPageCacheMixin, KeysetPaginationMixin, ListView):
     model = Post
     paginate_by = 30
     template_name = 'niji/topic.html'
@@ -93,16 +127,42 @@ class TopicView(ListView):
         return Post.objects.visible().filter(
             topic_id=self.kwargs.get('pk')
         ).select_related(
-            'user'
-        ).prefetch_related(
-            'user__forum_avatar'
-        ).order_by('pub_date')
+            'user', 'user__forum_avatar'
+        ).order_by(*with_tie_break(['pub_date']))
+
+    def get_topic(self):
+        if not hasattr(self, 'topic'):
+            self.topic = Topic.objects.visible().for_page().get(pk=self.kwargs.get('pk'))
+        return self.topic
+
+    def get_pagination_count(self, queryset):
+        # Visible replies are counted on the topic
+        return self.get_topic().reply_count
+
+    def get_page_cache_versions(self):
+        return [SITE, ('topic', self.kwargs.get('pk'))]
+
+    def get_last_modified(self):
+        return self.get_topic().last_modified
+
+    def served_from_cache(self):
+        Topic(pk=self.kwargs.get('pk')).increase_view_count()
+
+    def not_modified(self):
+        # A view however the page is answered
+        Topic(pk=self.kwargs.get('pk')).increase_view_count()
 
     def get_context_data(self, **kwargs):
         context = super(ListView, self).get_context_data(**kwargs)
-        current = Topic.objects.visible().get(pk=self.kwargs.get('pk'))
+        current = self.get_topic()
         current.increase_view_count()
+        appendices = list(current.appendix_set.order_by('pub_date', 'pk'))
+        if getattr(settings, 'NIJI_RERENDER_STALE_ON_READ', True):
+            current.rerender_if_stale()
+            for obj in itertools.chain(appendices, context['posts']):
+                obj.rerender_if_stale()
         context['topic'] = current
+        context['appendices'] = appendices
         context['title'] = context['topic'].title
         context['node'] = context['topic'].node
         context['form'] = ReplyForm()
@@ -110,7 +170,7 @@ class TopicView(ListView):
 
     @method_decorator(login_required)
     def post(self, request, *args, **kwargs):
-        current = Topic.objects.visible().get(pk=self.kwargs.get('pk'))
+        current = self.get_topic()
         if current.closed:
             return HttpResponseForbidden("Topic closed")
         topic_id = self.kwargs.get('pk')
@@ -136,7 +196,7 @@ def user_info(request, pk):
     })
 
 
-class UserTopics(ListView):
+class UserTopics(KeysetPaginationMixin, ListView):
     model = Post
     paginate_by = 30
     template_name = 'niji/user_topics.html'
@@ -149,6 +209,8 @@ class UserTopics(ListView):
             'user', 'node'
         ).prefetch_related(
             'user__forum_avatar'
+        ).order_by(
+            *with_tie_break(Topic._meta.ordering)
         )
 
     def get_context_data(self, **kwargs):
@@ -158,7 +220,7 @@ class UserTopics(ListView):
         return context
 
 
-class SearchView(ListView):
+class SearchView(KeysetPaginationMixin, ListView):
     model = Topic
     paginate_by = 30
     template_name = 'niji/search.html'
@@ -174,7 +236,7 @@ class SearchView(ListView):
         ).prefetch_related(
             'user__forum_avatar'
         ).order_by(
-            get_topic_ordering(self.request)
+            *with_tie_break([get_topic_ordering(self.request)])
         )
 
     def get_context_data(self, **kwargs):
@@ -264,7 +326,7 @@ def upload_avatar(request):
 @login_required
 def notification_view(request):
     notifications = request.user.received_notifications.all().order_by('-pub_date')
-    Notification.objects.filter(to=request.user).update(read=True)
+    mark_read(request.user.pk, Notification.objects.filter(to=request.user, read=False).update(read=True))
     return render(request, 'niji/notifications.html', {
         'title': _("Notifications"),
         'notifications': notifications,
@@ -279,7 +341,6 @@ class NotificationView(ListView):
     context_object_name = 'notifications'
 
     def get_queryset(self):
-        Notification.objects.filter(to=self.request.user).update(read=True)
         return Notification.objects.filter(
             to=self.request.user
         ).select_related(
@@ -291,9 +352,26 @@ class NotificationView(ListView):
     def get_context_data(self, **kwargs):
         context = super(ListView, self).get_context_data(**kwargs)
         context['title'] = _("Notifications")
+        # Only the unread notifications on this page are marked as read
+        unread = [notification.pk for notification in context['notifications'] if not notification.read]
+        if unread:
+            mark_read(
+                self.request.user.pk,
+                Notification.objects.filter(pk__in=unread, read=False).update(read=True)
+            )
         return context
 
 
+@login_required
+def mark_notifications_read(request):
+    if request.method == 'POST':
+        # Served by the (to, read, pub_date) index
+        mark_read(request.user.pk, Notification.objects.filter(to=request.user, read=False).update(read=True))
+        return HttpResponseRedirect(reverse('niji:notifications'))
+    else:
+        return HttpResponseForbidden('Get you cannot')
+
+
 def login_view(request):
     if request.method == "GET":
         return render(request, 'niji/login.html', {'title': _("Login")})